@@ -0,0 +1,116 @@
+# Server-side aggregation for the chart branches
+#
+# Plotly Express draws one mark per row it is given and sums them in the
+# browser. These helpers collapse the data to one row per group first, so
+# the figure payload depends on the number of groups rather than the number
+# of rows. Results are cached per dataset and parameters.
+import pandas as pd
+
+from cache import dataset_cache, dataset_key
+
+AGGREGATES = ['sum', 'mean', 'count', 'median']
+TOP_N = 25
+OTHER = 'Other'
+
+
+def group_columns(columns, *exclude):
+    # The distinct columns of a chart's groups in order, leaving out unset
+    # (None) widgets and the columns in exclude, such as the x of the chart
+    return [c for c in dict.fromkeys(columns) if c is not None and c not in exclude]
+
+
+def _keep_key(keep):
+    return tuple(sorted((c, tuple(v)) for c, v in (keep or {}).items()))
+
+
+def _fold(s, keep):
+    # Values of s outside keep (missing values aside) become OTHER
+    fold = s.notna() & ~s.isin(keep)
+    if not fold.any():
+        return s
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        if OTHER not in s.cat.categories:
+            s = s.cat.add_categories([OTHER])
+    else:
+        s = s.astype(object)
+    return s.mask(fold, OTHER)
+
+
+def top_categories(df, col, value=None, agg='sum', n=TOP_N):
+    # The n categories of col with the largest total of value (the most
+    # rows when the chart does not sum), and the number of categories
+    key = ('top', dataset_key(df), col, value, agg, n)
+
+    def compute():
+        if value is not None and agg == 'sum':
+            totals = df.groupby(df[col], observed=True)[value].sum()
+        else:
+            totals = df[col].value_counts()
+        return tuple(totals.nlargest(n).index), len(totals)
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+def fold_plan(source, columns, value=None, agg='sum', n=TOP_N):
+    # Which categories to keep for each categorical column of a chart, for
+    # group_agg's keep argument, and how many are folded into OTHER per
+    # column. source is a frame or an out-of-core store; numeric and date
+    # columns are never folded.
+    keep, folded = {}, {}
+    for col in group_columns(columns):
+        in_memory = isinstance(source, pd.DataFrame)
+        dtype = source[col].dtype if in_memory else source.dtypes[col]
+        if pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+            continue
+        top, total = top_categories(source, col, value, agg, n) if in_memory else source.top_categories(col, value, agg, n)
+        if total > len(top):
+            keep[col], folded[col] = top, total - len(top)
+    return keep, folded
+
+
+def folded_caption(folded):
+    parts = [f'{n:,} {"category" if n == 1 else "categories"} of {col}' for col, n in folded.items()]
+    return f'Grouped as {OTHER}: the smallest {", ".join(parts)}.' if parts else ''
+
+
+def group_agg(df, by, value=None, agg='sum', weighted_mean=(), keep=None):
+    # One row per combination of the by columns. The last column holds
+    # AGG(value), or the row count when value is None or agg is 'count'.
+    # Columns in weighted_mean are averaged with value (or the row count) as
+    # weights, which is how plotly colours sunburst and treemap sectors. The
+    # last column is named '<agg> of <value>' when value is also a by or
+    # weighted_mean column.
+    # keep maps columns to the values to keep; the rest are grouped as OTHER.
+    by = group_columns(by)
+    weighted_mean = group_columns(weighted_mean, *by)
+    keep = {c: v for c, v in (keep or {}).items() if c in by}
+    key = ('group', dataset_key(df), tuple(by), value, agg, tuple(weighted_mean), _keep_key(keep))
+
+    def compute():
+        counting = value is None or agg == 'count'
+        name = 'count' if counting else value
+        if name in by or name in weighted_mean:
+            name = f'{agg} of {name}'
+        if not by:
+            total = len(df) if counting else df[value].agg(agg)
+            return pd.DataFrame({name: [total]})
+
+        keys = [_fold(df[c], keep[c]) if c in keep else df[c] for c in by]
+        grouped = df.groupby(keys, observed=True, sort=False, dropna=False)
+        out = grouped.size() if counting else grouped[value].agg(agg)
+        out = out.to_frame(name)
+        if weighted_mean:
+            weights = df[value] if value is not None else pd.Series(1.0, index=df.index)
+            weight_sum = weights.groupby(keys, observed=True, sort=False, dropna=False).sum()
+            for c in weighted_mean:
+                out[c] = (df[c] * weights).groupby(keys, observed=True, sort=False, dropna=False).sum() / weight_sum
+            # Keep the measure as the last column
+            out = out[weighted_mean + [name]]
+        out = out.reset_index()
+        # The result is small; plain values avoid plotly's issues with unordered categoricals
+        for c in by:
+            if isinstance(out[c].dtype, pd.CategoricalDtype):
+                out[c] = out[c].astype(out[c].cat.categories.dtype)
+        return out
+
+    return dataset_cache.get_or_compute(key, compute)
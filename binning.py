@@ -0,0 +1,273 @@
+# Server-side binning for the Histogram and density charts
+#
+# px.histogram and the px.density_* charts ship every raw value to the
+# browser and bin it there. Here the x values of every color / facet group
+# are sorted once and cached; a histogram with any bin count or width is then
+# a searchsorted over the bin edges, and the box and violin marginals are
+# read off the same sorted arrays, so only bins and summaries reach the
+# figure. 2D charts get a binned grid (and a kernel density estimate of it)
+# per facet instead.
+import numpy as np
+import pandas as pd
+
+from aggregate import group_columns
+from cache import dataset_cache, dataset_key
+
+NBINS = 50
+MAX_BINS = 1000
+KDE_GRID = 128
+VIOLIN_POINTS = 256
+GROUP_COLUMN = 'bin group'
+
+
+def _as_float(values):
+    # Dates are binned on their nanosecond timestamps
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.to_numpy().astype('datetime64[ns]').astype(np.int64).astype(float)
+    return values.to_numpy(dtype=float, na_value=np.nan)
+
+
+def _weights(values):
+    # What each row adds to its bin: y itself, or 1 for every non-missing y
+    # when y is not numeric, as px.histogram(histfunc='count') counts it
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+        return np.nan_to_num(_as_float(values))
+    return values.notna().to_numpy(dtype=float)
+
+
+def _as_values(values, dtype):
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return pd.to_datetime(np.asarray(values, dtype=np.int64))
+    return values
+
+
+def sorted_groups(df, x, y=None, by=()):
+    # {group key: (sorted x, running sum of y in the same order)} for every
+    # combination of the by columns. Rows with a missing x are left out and a
+    # missing y counts as 0, as in px.histogram; see _weights.
+    by = group_columns(by, x)
+    key = ('sorted-groups', dataset_key(df), x, y, tuple(by))
+
+    def compute():
+        xs = _as_float(df[x])
+        ys = None if y is None else _weights(df[y])
+        groups = df.groupby([df[c] for c in by], observed=True).indices if by else {(): np.arange(len(df))}
+        out = {}
+        for name, positions in groups.items():
+            positions = positions[~np.isnan(xs[positions])]
+            positions = positions[np.argsort(xs[positions], kind='stable')]
+            totals = None if ys is None else np.r_[0, np.cumsum(ys[positions])]
+            out[name if isinstance(name, tuple) else (name,)] = (xs[positions], totals)
+        return out
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+def bin_edges(lo, hi, nbins=NBINS, width=None):
+    # A width that would give more than MAX_BINS bins is widened to fit
+    if hi <= lo:
+        hi = lo + 1
+    if width:
+        width = max(width, (hi - lo) / MAX_BINS)
+        return lo + np.arange(min(max(int(np.ceil((hi - lo) / width)), 1), MAX_BINS) + 1) * width
+    return np.linspace(lo, hi, min(nbins, MAX_BINS) + 1)
+
+
+def histogram(df, x, y=None, by=(), nbins=NBINS, width=None):
+    # Sum of y (or the row count) per bin and group, as one row per non-empty
+    # bin with the bin centre in column x. GROUP_COLUMN numbers the groups in
+    # the order of sorted_groups. Returns the frame and the bin edges.
+    by = group_columns(by, x)
+    groups = sorted_groups(df, x, y, by)
+    filled = [xs for xs, _ in groups.values() if len(xs)]
+    lo = min(xs[0] for xs in filled) if filled else 0.0
+    hi = max(xs[-1] for xs in filled) if filled else 1.0
+    edges = bin_edges(lo, hi, nbins, width)
+    centres = edges[:-1] + np.diff(edges) / 2
+    name = y or 'count'
+    frames = []
+    for i, (group, (xs, totals)) in enumerate(groups.items()):
+        pos = np.searchsorted(xs, edges)
+        # The last bin is closed on the right
+        pos[-1] = len(xs)
+        counts = np.diff(pos)
+        keep = counts > 0
+        values = counts if totals is None else np.diff(totals[pos])
+        frame = pd.DataFrame({x: centres[keep], name: values[keep]})
+        for col, value in zip(by, group):
+            frame[col] = value
+        frame[GROUP_COLUMN] = i
+        frames.append(frame)
+    out = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[x, name, *by, GROUP_COLUMN])
+    out[x] = _as_values(out[x], df[x].dtype)
+    for col in by:
+        out[col] = out[col].astype(df[col].dtype)
+    return out[[*by, x, name, GROUP_COLUMN]], _as_values(edges, df[x].dtype)
+
+
+def xbins(edges):
+    # Bin settings for the histogram traces, so plotly keeps the server bins
+    size = edges[1] - edges[0]
+    if isinstance(size, pd.Timedelta):
+        # Date bins are sized in milliseconds
+        size = size / pd.Timedelta(milliseconds=1)
+    return dict(start=edges[0], end=edges[-1], size=size)
+
+
+def _quantiles(xs, qs, weights=None):
+    # Quantiles of a sorted array, or of sorted bin centres with bin counts
+    if weights is None:
+        return np.quantile(xs, qs)
+    # Each bin's weight is taken to sit around its centre
+    cum = np.cumsum(weights)
+    return np.interp(np.asarray(qs) * cum[-1], cum - np.asarray(weights) / 2, xs)
+
+
+def box_summary(xs, weights=None):
+    # Quartiles, Tukey fences and mean of a sorted array
+    q1, median, q3 = _quantiles(xs, [0.25, 0.5, 0.75], weights)
+    iqr = q3 - q1
+    lower = xs[np.searchsorted(xs, q1 - 1.5 * iqr)]
+    upper = xs[np.searchsorted(xs, q3 + 1.5 * iqr, side='right') - 1]
+    mean = xs.mean() if weights is None else np.average(xs, weights=weights)
+    return {'q1': q1, 'median': median, 'q3': q3, 'lowerfence': lower, 'upperfence': upper, 'mean': mean}
+
+
+def quantile_grid(xs, n=VIOLIN_POINTS, weights=None):
+    # n evenly spaced quantiles: a fixed-size stand-in with the same density
+    if weights is None and len(xs) <= n:
+        return xs
+    if weights is None:
+        return xs[np.linspace(0, len(xs) - 1, n).round().astype(np.int64)]
+    return _quantiles(xs, (np.arange(n) + 0.5) / n, weights)
+
+
+def _summary_traces(fig):
+    # The box and violin marginals tagged with GROUP_COLUMN. px draws rugs as
+    # box traces showing all points, and those are left alone.
+    for trace in fig.data:
+        if trace.type not in ('box', 'violin') or (trace.type == 'box' and trace.boxpoints == 'all'):
+            continue
+        if trace.customdata is not None and len(trace.customdata):
+            yield trace
+
+
+def summarize_marginals(fig, df, x, y=None, by=()):
+    # Swap the raw values in the box and violin marginal traces of a figure
+    # drawn from histogram() for summaries of the full groups. The traces are
+    # matched to their group through GROUP_COLUMN, passed as hover data.
+    groups = list(sorted_groups(df, x, y, group_columns(by, x)).values())
+    dtype = df[x].dtype
+    for trace in _summary_traces(fig):
+        xs = groups[int(trace.customdata[0][0])][0]
+        if not len(xs):
+            continue
+        if trace.type == 'box':
+            summary = {k: _as_values([v], dtype) for k, v in box_summary(xs).items()}
+            trace.update(x=None, orientation='h', boxpoints=False, **summary)
+        else:
+            trace.update(x=_as_values(quantile_grid(xs), dtype), points=False)
+        trace.update(customdata=None, hovertemplate=None)
+    return fig
+
+
+def histogram2d(df, x, y, by=(), nbinsx=NBINS, nbinsy=NBINS):
+    # Counts on an nbinsx x nbinsy grid shared by all groups, as one row per
+    # non-empty cell with the cell centre in columns x and y (the shape of
+    # SQLStore.histogram2d). Returns the frame and the x and y bin edges.
+    by = group_columns(by, x, y)
+    key = ('histogram2d', dataset_key(df), x, y, tuple(by), nbinsx, nbinsy)
+
+    def compute():
+        xs, ys = df[x].to_numpy(dtype=float, na_value=np.nan), df[y].to_numpy(dtype=float, na_value=np.nan)
+        ok = ~(np.isnan(xs) | np.isnan(ys))
+        xedges = bin_edges(xs[ok].min(), xs[ok].max(), nbinsx) if ok.any() else bin_edges(0, 1, nbinsx)
+        yedges = bin_edges(ys[ok].min(), ys[ok].max(), nbinsy) if ok.any() else bin_edges(0, 1, nbinsy)
+        xcentres, ycentres = xedges[:-1] + np.diff(xedges) / 2, yedges[:-1] + np.diff(yedges) / 2
+        groups = df.groupby([df[c] for c in by], observed=True).indices if by else {(): np.arange(len(df))}
+        frames = []
+        for i, (group, positions) in enumerate(groups.items()):
+            positions = positions[ok[positions]]
+            counts, _, _ = np.histogram2d(xs[positions], ys[positions], bins=[xedges, yedges])
+            ix, iy = np.nonzero(counts)
+            frame = pd.DataFrame({x: xcentres[ix], y: ycentres[iy], 'count': counts[ix, iy]})
+            for col, value in zip(by, group if isinstance(group, tuple) else (group,)):
+                frame[col] = value
+            frame[GROUP_COLUMN] = i
+            frames.append(frame)
+        out = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[*by, x, y, 'count', GROUP_COLUMN])
+        for col in by:
+            out[col] = out[col].astype(df[col].dtype)
+        return out[[*by, x, y, 'count', GROUP_COLUMN]], xedges, yedges
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+def summarize_binned_marginals(fig, data, x, y, weight='count'):
+    # summarize_marginals for 2D charts, reading the box and violin marginals
+    # off the binned cells instead of the raw rows: x marginals sum the cells
+    # over y and y marginals sum them over x
+    for trace in _summary_traces(fig):
+        col = x if trace.x is not None else y
+        cells = data.loc[data[GROUP_COLUMN] == int(trace.customdata[0][0])]
+        totals = cells.groupby(col)[weight].sum()
+        if not len(totals):
+            continue
+        centres, counts = totals.index.to_numpy(dtype=float), totals.to_numpy(dtype=float)
+        if trace.type == 'box':
+            summary = {k: [v] for k, v in box_summary(centres, counts).items()}
+            trace.update(x=None, y=None, orientation='h' if col == x else 'v', boxpoints=False, **summary)
+        else:
+            trace.update(**{'x' if col == x else 'y': quantile_grid(centres, weights=counts)}, points=False)
+        trace.update(customdata=None, hovertemplate=None)
+    return fig
+
+
+def _gaussian_fft(grid, sx, sy):
+    # Convolve a grid with a Gaussian of sx by sy cells, zero-padded so that
+    # the FFT does not wrap density around the edges
+    nx, ny = grid.shape
+    px_, py_ = nx + 2 * int(np.ceil(3 * sx)), ny + 2 * int(np.ceil(3 * sy))
+    fx, fy = np.fft.fftfreq(px_)[:, None], np.fft.rfftfreq(py_)[None, :]
+    kernel = np.exp(-2 * np.pi ** 2 * ((sx * fx) ** 2 + (sy * fy) ** 2))
+    smoothed = np.fft.irfft2(np.fft.rfft2(grid, s=(px_, py_)) * kernel, s=(px_, py_))
+    return np.clip(smoothed[:nx, :ny], 0, None)
+
+
+def kde2d(df, x, y, by=(), gridsize=KDE_GRID):
+    # Gaussian kernel density on a gridsize x gridsize grid per group, with
+    # Scott's rule bandwidths. The points are binned once and the kernel is
+    # applied with an FFT, so the cost is set by the grid, not the row count.
+    # Returns a frame shaped like histogram2d with a 'density' column.
+    by = group_columns(by, x, y)
+    key = ('kde2d', dataset_key(df), x, y, tuple(by), gridsize)
+
+    def compute():
+        xs, ys = df[x].to_numpy(dtype=float, na_value=np.nan), df[y].to_numpy(dtype=float, na_value=np.nan)
+        ok = ~(np.isnan(xs) | np.isnan(ys))
+        n = max(int(ok.sum()), 2)
+        hx, hy = (np.std(v[ok]) * n ** (-1 / 6) if ok.any() else 1.0 for v in (xs, ys))
+        hx, hy = hx or 1.0, hy or 1.0
+        # Pad the grid by the bandwidth so the contours can close
+        xedges = bin_edges(xs[ok].min() - 3 * hx, xs[ok].max() + 3 * hx, gridsize) if ok.any() else bin_edges(0, 1, gridsize)
+        yedges = bin_edges(ys[ok].min() - 3 * hy, ys[ok].max() + 3 * hy, gridsize) if ok.any() else bin_edges(0, 1, gridsize)
+        dx, dy = xedges[1] - xedges[0], yedges[1] - yedges[0]
+        xcentres, ycentres = xedges[:-1] + dx / 2, yedges[:-1] + dy / 2
+        groups = df.groupby([df[c] for c in by], observed=True).indices if by else {(): np.arange(len(df))}
+        frames = []
+        for i, (group, positions) in enumerate(groups.items()):
+            positions = positions[ok[positions]]
+            counts, _, _ = np.histogram2d(xs[positions], ys[positions], bins=[xedges, yedges])
+            density = _gaussian_fft(counts, hx / dx, hy / dy) / max(len(positions), 1) / (dx * dy)
+            # Cells that round to zero are left out; plotly fills them with 0
+            ix, iy = np.nonzero(density > density.max() * 1e-6)
+            frame = pd.DataFrame({x: xcentres[ix], y: ycentres[iy], 'density': density[ix, iy]})
+            for col, value in zip(by, group if isinstance(group, tuple) else (group,)):
+                frame[col] = value
+            frames.append(frame)
+        out = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[*by, x, y, 'density'])
+        for col in by:
+            out[col] = out[col].astype(df[col].dtype)
+        return out[[*by, x, y, 'density']], xedges, yedges
+
+    return dataset_cache.get_or_compute(key, compute)
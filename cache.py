@@ -0,0 +1,137 @@
+# Shared in-process caches
+#
+# Streamlit re-executes main.py from top to bottom on every widget change, so
+# anything kept in main.py is lost between reruns. Imported modules stay in
+# sys.modules for the lifetime of the server process, which means the caches
+# below are shared by every rerun and every browser session.
+import itertools
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def object_size(obj):
+    # Approximate resident size of a cached value in bytes
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(object_size(o) for o in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(object_size(k) + object_size(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes, sizeof=object_size):
+        self.max_bytes = int(max_bytes)
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            # Values larger than the whole budget are returned but never stored
+            if size > self.max_bytes:
+                return value
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.nbytes -= evicted
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.put(key, compute())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+
+_MISSING = object()
+
+
+_dataset_keys = {}
+_dataset_counter = itertools.count()
+_key_lock = threading.Lock()
+
+
+def dataset_key(df):
+    # Stable token for an in-memory dataset. Loaded frames come out of
+    # dataset_cache, so the same object is seen on every rerun; the weak
+    # reference guards against a new frame reusing the id of a freed one.
+    with _key_lock:
+        entry = _dataset_keys.get(id(df))
+        if entry is not None and entry[0]() is df:
+            return entry[1]
+        token = f'df-{next(_dataset_counter)}'
+        _dataset_keys[id(df)] = (weakref.ref(df, lambda _, i=id(df): _dataset_keys.pop(i, None)), token)
+        return token
+
+
+def _payload_size(value):
+    # Approximate size of a plotly property tree, dominated by its arrays
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(len(k) + _payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_payload_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value)
+    return 8
+
+
+def figure_size(entry):
+    # A figure with its notes, sized from its trace data without serializing
+    # it (the cache exists to avoid that work)
+    fig, notes = entry
+    return sum(_payload_size(trace.to_plotly_json()) for trace in fig.data) + object_size(list(notes))
+
+
+def _budget(env_var, default_mb):
+    return int(float(os.environ.get(env_var, default_mb)) * 1024 ** 2)
+
+
+# Parsed datasets, keyed on the content hash of the upload plus the parse options
+dataset_cache = LRUCache(_budget('PEDAL_DATASET_CACHE_MB', 2048))
+
+# Built figures of the Visualization page, keyed on the dataset, chart type
+# and sidebar settings (see figures.py)
+figure_cache = LRUCache(_budget('PEDAL_FIGURE_CACHE_MB', 256), sizeof=figure_size)
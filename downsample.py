@@ -0,0 +1,88 @@
+# Downsampling of long series for the Line and Area charts
+#
+# A browser cannot draw millions of points per line, and it does not need
+# to: a few thousand well chosen points per series look the same. Both
+# methods below keep the local extremes, so peaks and troughs survive.
+import numpy as np
+import pandas as pd
+
+from aggregate import group_columns
+from cache import dataset_cache, dataset_key
+
+METHODS = ['LTTB', 'min/max']
+
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets (Steinarsson, 2013). x must be sorted.
+    # The first and last points are kept; from every bucket in between the
+    # point forming the largest triangle with the previously kept point and
+    # the average of the next bucket is kept.
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    next_edges = np.r_[edges[2:], n]
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = edges[i + 1], next_edges[i]
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax()) if hi > lo else a
+        out[i + 1] = a
+    return np.unique(out)
+
+
+def minmax_indices(y, n_out):
+    # The minimum and maximum of each of n_out / 2 equal-count buckets,
+    # plus the end points, found for all buckets at once
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+    bucket = np.arange(n) * (n_out // 2) // n
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    order = np.lexsort((y, bucket))
+    ends = np.r_[starts[1:], n] - 1
+    return np.unique(np.r_[0, order[starts], order[ends], n - 1])
+
+
+def _numeric_x(x):
+    if pd.api.types.is_datetime64_any_dtype(x):
+        return x.to_numpy().astype('datetime64[ns]').astype(np.int64).astype(float)
+    if pd.api.types.is_numeric_dtype(x):
+        return x.to_numpy(dtype=float)
+    return None
+
+
+def downsample_series(df, x, y, by=(), n_out=2000, method='LTTB'):
+    # Downsample every series (one per combination of the by columns) to at
+    # most n_out points. Returns the reduced frame and (rows in, rows out,
+    # number of series). Series with a non-numeric y are left alone.
+    by = group_columns(by, x, y)
+    key = ('downsample', dataset_key(df), x, y, tuple(by), n_out, method)
+
+    def compute():
+        cols = list(dict.fromkeys([x, y] + by))
+        if not pd.api.types.is_numeric_dtype(df[y]) or len(df) <= n_out:
+            return df[cols], (len(df), len(df), 1)
+        xs = _numeric_x(df[x])
+        ys = df[y].to_numpy(dtype=float)
+        groups = df.groupby([df[c] for c in by], observed=True, sort=False).indices if by else {None: np.arange(len(df))}
+        keep = []
+        for positions in groups.values():
+            if xs is not None:
+                # Lines are drawn in x order, which the bucketing relies on
+                positions = positions[np.argsort(xs[positions], kind='stable')]
+            if len(positions) <= n_out:
+                keep.append(positions)
+            elif method == 'LTTB':
+                gx = xs[positions] if xs is not None else np.arange(len(positions), dtype=float)
+                keep.append(positions[lttb_indices(gx, ys[positions], n_out)])
+            else:
+                keep.append(positions[minmax_indices(ys[positions], n_out)])
+        keep = np.concatenate(keep)
+        return df[cols].iloc[keep], (len(df), len(keep), len(groups))
+
+    return dataset_cache.get_or_compute(key, compute)
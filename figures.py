@@ -0,0 +1,71 @@
+# Figure cache for the Visualization page
+#
+# Every press of "Click to generate graph" used to rebuild the px figure,
+# and because Streamlit reruns the whole script on any widget change, the
+# figure disappeared again on the next rerun. Built figures are now kept in
+# figure_cache, keyed on the dataset, the chart type and the values of the
+# chart's sidebar widgets, so regenerating an unchanged chart only redraws it. Each
+# session also remembers the last figure of every chart type and keeps it on
+# screen until the chart is generated again.
+import pandas as pd
+import streamlit as st
+
+from cache import dataset_key, figure_cache
+
+LAST_FIGURES = 'last figures'
+
+
+class ChartNotes(list):
+    # Captions and warnings written while a figure is built, kept with the
+    # figure so they are shown again when it is redrawn from the cache
+
+    def caption(self, text):
+        self.append(('caption', text))
+
+    def warning(self, text):
+        self.append(('warning', text))
+
+    def info(self, text):
+        self.append(('info', text))
+
+    def show(self):
+        for kind, text in self:
+            getattr(st, kind)(text)
+
+
+def figure_key(source, chart, widgets):
+    # Dataset token, chart type and the values of the chart's own widgets
+    # (by key; widgets not shown in this run count as None)
+    dataset = dataset_key(source) if isinstance(source, pd.DataFrame) else source.path
+    return dataset, chart, tuple((key, repr(st.session_state.get(key))) for key in widgets)
+
+
+def _draw(chart, entry):
+    st.session_state.setdefault(LAST_FIGURES, {})[chart] = entry
+    fig, notes = entry
+    notes.show()
+    st.plotly_chart(fig)
+
+
+def show_figure(chart, key, fig, notes):
+    entry = (fig, notes)
+    figure_cache.put(key, entry)
+    _draw(chart, entry)
+
+
+def show_cached_figure(chart, key):
+    # Draw the figure for key if it is cached; False when it has to be built
+    entry = figure_cache.get(key)
+    if entry is None:
+        return False
+    _draw(chart, entry)
+    return True
+
+
+def show_last_figure(chart):
+    # Redraw the figure this session last generated for the chart type
+    entry = st.session_state.get(LAST_FIGURES, {}).get(chart)
+    if entry is not None:
+        fig, notes = entry
+        notes.show()
+        st.plotly_chart(fig)
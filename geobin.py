@@ -0,0 +1,95 @@
+# Spatial binning for the Scatter Geo chart
+#
+# A map with millions of markers never finishes loading. Instead each point
+# is snapped to a cell of a square or hexagonal lon/lat grid and the map draws
+# one marker per occupied cell, with the point count (or the summed size
+# column) and the most frequent hover label of the cell. The grid spans the
+# map scope being shown, so zooming to a smaller region gives finer cells.
+import numpy as np
+import pandas as pd
+
+from aggregate import group_columns
+from cache import dataset_cache, dataset_key
+from raster import source_chunks
+
+SHAPES = ['square', 'hex']
+CELLS = 120
+# Lon / lat bounds of the plotly geo scopes
+SCOPES = {
+    'world': ((-180, 180), (-90, 90)),
+    'usa': ((-125, -66), (24, 50)),
+    'europe': ((-25, 45), (34, 72)),
+    'asia': ((25, 150), (-11, 78)),
+    'africa': ((-20, 55), (-36, 38)),
+    'north america': ((-170, -50), (7, 84)),
+    'south america': ((-82, -34), (-56, 13)),
+}
+
+
+def square_cells(lons, lats, step, lon0, lat0):
+    # Centres of the step x step degree squares holding each point
+    ix = np.floor((lons - lon0) / step)
+    iy = np.floor((lats - lat0) / step)
+    return lon0 + (ix + 0.5) * step, lat0 + (iy + 0.5) * step
+
+
+def hex_cells(lons, lats, step, lon0, lat0):
+    # Centres of the hexagons holding each point. The hexagon centres are the
+    # union of two rectangular lattices offset by half a cell, so each point
+    # is snapped to the nearer of its candidate centres on both (the same
+    # scheme as matplotlib's hexbin). step is the distance between the
+    # centres of neighbouring hexagons in a row.
+    sx, sy = step, step * np.sqrt(3)
+    x = (lons - lon0) / sx
+    y = (lats - lat0) / sy
+    ix1, iy1 = np.round(x), np.round(y)
+    ix2, iy2 = np.floor(x), np.floor(y)
+    d1 = (x - ix1) ** 2 + 3 * (y - iy1) ** 2
+    d2 = (x - ix2 - 0.5) ** 2 + 3 * (y - iy2 - 0.5) ** 2
+    first = d1 <= d2
+    cx = np.where(first, ix1, ix2 + 0.5)
+    cy = np.where(first, iy1, iy2 + 0.5)
+    return lon0 + cx * sx, lat0 + cy * sy
+
+
+def geo_bins(source, lon, lat, size=None, label=None, shape='square', cells=CELLS, scope='world'):
+    # Bin the lon/lat points of a frame or SQLStore inside a map scope into a
+    # grid cells wide. Returns a frame with one row per occupied cell: the
+    # cell centre (under the lon / lat column names), 'count', the sum of the
+    # size column and the most frequent label.
+    label = None if label in (lon, lat) else label
+    (lon0, lon1), (lat0, lat1) = SCOPES[scope]
+    step = (lon1 - lon0) / cells
+    snap = hex_cells if shape == 'hex' else square_cells
+    key = ('geo-bins', dataset_key(source) if isinstance(source, pd.DataFrame) else source.path,
+           lon, lat, size, label, shape, cells, scope)
+
+    def compute():
+        cols = group_columns([lon, lat, size, label])
+        parts = []
+        for chunk in source_chunks(source, cols):
+            lons = chunk[lon].to_numpy(dtype=float, na_value=np.nan)
+            lats = chunk[lat].to_numpy(dtype=float, na_value=np.nan)
+            keep = (lons >= lon0) & (lons <= lon1) & (lats >= lat0) & (lats <= lat1)
+            xs, ys = snap(lons[keep], lats[keep], step, lon0, lat0)
+            part = pd.DataFrame({lon: xs, lat: ys, 'count': 1.0})
+            if size is not None:
+                part['sum'] = chunk[size].to_numpy(dtype=float, na_value=np.nan)[keep]
+            if label is not None:
+                part['label'] = chunk[label].to_numpy()[keep]
+            # Reduce every chunk to (cell, label) rows before collecting them
+            by = [lon, lat] + (['label'] if label is not None else [])
+            parts.append(part.groupby(by, sort=False, dropna=False).sum().reset_index())
+        if not parts:
+            return pd.DataFrame(columns=[lon, lat, 'count'])
+        binned = pd.concat(parts, ignore_index=True)
+        if label is None:
+            return binned.groupby([lon, lat], sort=False).sum().reset_index()
+        by = binned.groupby([lon, lat, 'label'], sort=False, dropna=False).sum().reset_index()
+        totals = by.groupby([lon, lat], sort=False)[[c for c in ('count', 'sum') if c in by]].sum()
+        # The label with the most points in each cell
+        top = by.sort_values('count', ascending=False, kind='stable').drop_duplicates([lon, lat])
+        totals[label] = top.set_index([lon, lat])['label']
+        return totals.reset_index()
+
+    return dataset_cache.get_or_compute(key, compute)
@@ -0,0 +1,115 @@
+# Hierarchy index for the Sunburst and Treemap charts
+#
+# Plotly's path mode builds every sector from the rows it is given, at every
+# generate. Here the leaves (one row per path combination, from group_agg)
+# are rolled up once per dataset and path into a table of nodes with ids,
+# parents and totals. Small children are folded into an "Other" node per
+# parent, and a chart only takes the levels it shows from the index, so
+# drilling into a branch never regroups the data. An id is the path of
+# labels with the separator escaped inside labels, and a folded node gets a
+# segment no label escapes to, so ids stay unique whatever the labels hold.
+import re
+
+import numpy as np
+import pandas as pd
+
+from cache import dataset_cache, dataset_key
+
+MAX_CHILDREN = 20
+OTHER = 'Other'
+MIXED = '(?)'
+SEPARATOR = '/'
+# Id segment of the folded nodes; _escape never produces it
+OTHER_SEGMENT = '\\*'
+_SEGMENT = re.compile(r'(?:\\.|[^\\/])+')
+
+
+def _escape(labels):
+    return labels.str.replace('\\', '\\\\', regex=False).str.replace(SEPARATOR, '\\' + SEPARATOR, regex=False)
+
+
+def _join(parent, segment):
+    return parent.where(parent == '', parent + SEPARATOR).str.cat(segment)
+
+
+def node_path(node):
+    # The labels along a node id, for display
+    if node is None:
+        return 'Everything'
+    labels = [OTHER if segment == OTHER_SEGMENT else re.sub(r'\\(.)', r'\1', segment)
+              for segment in _SEGMENT.findall(node)]
+    return ' / '.join(labels)
+
+
+def _roll_up(rows, value, color, numeric_color):
+    # One node per id with the summed value and the color of its leaves
+    grouped = rows.groupby('id', sort=False)
+    nodes = grouped.agg(parent=('parent', 'first'), label=('label', 'first'), value=(value, 'sum'))
+    if color is not None and numeric_color:
+        # Weighted by value, as plotly colours parent sectors
+        weighted = (rows[color] * rows[value]).groupby(rows['id'], sort=False).sum()
+        nodes['color'] = weighted / nodes['value'].replace(0, np.nan)
+    elif color is not None:
+        colors = grouped[color].agg(['first', 'nunique'])
+        nodes['color'] = colors['first'].where(colors['nunique'] <= 1, MIXED)
+    return nodes.reset_index()
+
+
+def hierarchy_index(leaves, path, value, color=None, max_children=MAX_CHILDREN):
+    # Every node of the path hierarchy over a leaf table, as a frame with
+    # columns id, parent, label, level, value (and color). Within a parent
+    # only the max_children largest children are kept and the rest are
+    # folded into one OTHER node with no children of its own.
+    key = ('hierarchy', dataset_key(leaves), tuple(path), value, color, max_children)
+
+    def compute():
+        numeric_color = color is not None and pd.api.types.is_numeric_dtype(leaves[color]) and color not in path
+        columns = list(dict.fromkeys([value] + ([color] if color is not None else [])))
+        ids = pd.Series('', index=leaves.index, dtype=object)
+        folded = np.zeros(len(leaves), dtype=bool)
+        levels = []
+        for level, col in enumerate(path):
+            live = np.flatnonzero(~folded)
+            step = leaves.iloc[live][columns].copy()
+            step['parent'] = ids.iloc[live].to_numpy()
+            step['label'] = leaves[col].iloc[live].astype(str).to_numpy()
+            step['segment'] = _escape(step['label'])
+            step['id'] = _join(step['parent'], step['segment'])
+            nodes = _roll_up(step, value, color, numeric_color)
+            # Rank the children of every parent and fold the tail
+            rank = nodes.groupby('parent', sort=False)['value'].rank(method='first', ascending=False)
+            fold = step['id'].isin(set(nodes.loc[rank > max_children, 'id'])).to_numpy()
+            if fold.any():
+                step.loc[fold, 'label'] = OTHER
+                step.loc[fold, 'segment'] = OTHER_SEGMENT
+                step['id'] = _join(step['parent'], step['segment'])
+                nodes = _roll_up(step, value, color, numeric_color)
+            nodes['level'] = level
+            levels.append(nodes)
+            ids.iloc[live] = step['id'].to_numpy()
+            folded[live[fold]] = True
+        if not levels:
+            return pd.DataFrame(columns=['id', 'parent', 'label', 'value', 'level'])
+        return pd.concat(levels, ignore_index=True)
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+def subtree(index, root=None, depth=3):
+    # The nodes to draw: depth levels below root (the whole hierarchy when
+    # root is None), with root itself as the centre of the chart
+    if root is None:
+        return index.loc[index['level'] < depth]
+    top = index.loc[index['id'] == root]
+    if not len(top):
+        return index.loc[index['level'] < depth]
+    level = top['level'].iloc[0]
+    inside = index['id'].str.startswith(root + SEPARATOR) & (index['level'] <= level + depth)
+    return pd.concat([top.assign(parent=''), index.loc[inside]], ignore_index=True)
+
+
+def drill_targets(index, levels=2):
+    # Ids of the nodes with children in the top levels, for a drill-down picker
+    parents = set(index['parent'])
+    nodes = index.loc[(index['level'] < levels) & index['id'].isin(parents), 'id']
+    return list(nodes)
@@ -0,0 +1,499 @@
+# Dataset loading for PEDAL
+#
+# A dataset source is either a streamlit UploadedFile or the path of a file on
+# the server. Csv files are parsed in chunks, compressed csv files are
+# decompressed on the fly while they are parsed; Parquet, Feather and Arrow IPC
+# files are read with pyarrow, memory-mapped when they come from disk.
+import bz2
+import contextlib
+import glob
+import gzip
+import hashlib
+import io
+import lzma
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from cache import dataset_cache
+
+
+_digests = {}
+
+
+CSV_TYPES = ['csv']
+COMPRESSED_TYPES = ['gz', 'zip', 'bz2', 'xz']
+ARROW_TYPES = ['parquet', 'feather', 'arrow', 'ipc', 'arrows']
+DATASET_TYPES = CSV_TYPES + COMPRESSED_TYPES + ARROW_TYPES
+
+
+def source_name(source):
+    return source if isinstance(source, str) else getattr(source, 'name', '')
+
+
+def file_format(source):
+    name = source_name(source).lower()
+    ext = name.rsplit('.', 1)[-1] if '.' in name else ''
+    return ext if ext in ARROW_TYPES else 'csv'
+
+
+def list_data_files(data_dir):
+    # Supported files below a server-side data directory, relative to it
+    found = []
+    for root, _, files in os.walk(data_dir):
+        for f in files:
+            if f.rsplit('.', 1)[-1].lower() in DATASET_TYPES:
+                found.append(os.path.relpath(os.path.join(root, f), data_dir))
+    return sorted(found)
+
+
+def glob_data_files(data_dir, pattern):
+    # Supported files matching a glob pattern, restricted to the data directory
+    if not pattern:
+        return []
+    root = os.path.realpath(data_dir)
+    found = []
+    for path in glob.glob(os.path.join(root, pattern), recursive=True):
+        path = os.path.realpath(path)
+        if (os.path.isfile(path) and path.startswith(root + os.sep)
+                and path.rsplit('.', 1)[-1].lower() in DATASET_TYPES):
+            found.append(os.path.relpath(path, root))
+    return sorted(found)
+
+
+class NamedBytesIO(io.BytesIO):
+    # In-memory file with a name, used to hand uploads to worker processes
+    def __init__(self, data, name):
+        super().__init__(data)
+        self.name = name
+
+
+def _rewind(source):
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source
+
+
+@contextlib.contextmanager
+def open_csv(source):
+    # Yield something pd.read_csv can read. Compressed files are wrapped in a
+    # streaming decoder, so the decompressed text is only ever held one chunk
+    # at a time and never written to a temp file.
+    ext = source_name(source).lower().rsplit('.', 1)[-1]
+    if ext not in COMPRESSED_TYPES:
+        yield _rewind(source)
+        return
+
+    with contextlib.ExitStack() as stack:
+        raw = stack.enter_context(open(source, 'rb')) if isinstance(source, str) else _rewind(source)
+        if ext == 'gz':
+            stream = gzip.GzipFile(fileobj=raw)
+        elif ext == 'bz2':
+            stream = bz2.BZ2File(raw)
+        elif ext == 'xz':
+            stream = lzma.LZMAFile(raw)
+        else:
+            archive = stack.enter_context(zipfile.ZipFile(raw))
+            members = [m for m in archive.namelist() if not m.endswith('/')]
+            csv_members = [m for m in members if m.lower().endswith('.csv')]
+            stream = archive.open((csv_members or members)[0])
+        yield stack.enter_context(stream)
+
+
+def fingerprint(uploaded):
+    # Content hash of an uploaded file. Hashing a few hundred MB still takes a
+    # moment, so the digest is remembered per upload and only computed once.
+    # Files on the server are identified by path, size and modification time.
+    if isinstance(uploaded, str):
+        st = os.stat(uploaded)
+        return f'{os.path.abspath(uploaded)}:{st.st_size}:{st.st_mtime_ns}'
+
+    upload_key = (getattr(uploaded, 'id', None) or getattr(uploaded, 'file_id', None),
+                  getattr(uploaded, 'name', None), getattr(uploaded, 'size', None))
+    if upload_key[0] is not None and upload_key in _digests:
+        return _digests[upload_key]
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(uploaded.getbuffer())
+    digest = h.hexdigest()
+
+    if upload_key[0] is not None:
+        if len(_digests) > 1024:
+            _digests.clear()
+        _digests[upload_key] = digest
+    return digest
+
+
+def _options_key(options):
+    return tuple(sorted((k, repr(v)) for k, v in options.items()))
+
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024 or unit == 'GB':
+            break
+        n /= 1024
+    return f'{n:,.0f} {unit}' if unit == 'B' else f'{n:,.1f} {unit}'
+
+
+CHUNKSIZE = 200_000
+CATEGORY_MAX_UNIQUE = 1000
+CATEGORY_MAX_RATIO = 0.5
+
+
+def infer_dtypes(sample):
+    # Pick compact dtypes from a sample chunk: 'integer' / 'float' mean
+    # downcast with pd.to_numeric, 'category' is used for low-cardinality text
+    plan = {}
+    for col in sample.columns:
+        s = sample[col]
+        if pd.api.types.is_bool_dtype(s):
+            continue
+        if pd.api.types.is_integer_dtype(s):
+            plan[col] = 'integer'
+        elif pd.api.types.is_float_dtype(s):
+            plan[col] = 'float'
+        elif pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s):
+            n_unique = s.nunique(dropna=True)
+            if n_unique <= CATEGORY_MAX_UNIQUE and n_unique <= CATEGORY_MAX_RATIO * max(len(s), 1):
+                plan[col] = 'category'
+    return plan
+
+
+def _is_text(s):
+    return (isinstance(s.dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(s)
+            or pd.api.types.is_string_dtype(s))
+
+
+def _as_text(s):
+    # Values as strings, missing values left missing. Whole floats are
+    # written as integers, as pandas reads a column of integers with gaps as
+    # floats.
+    text = s.astype(str)
+    if pd.api.types.is_float_dtype(s):
+        whole = s.notna() & (s % 1 == 0)
+        text = text.mask(whole, s[whole].astype(np.int64).astype(str))
+    return text.where(s.notna())
+
+
+def _compact(chunk, plan):
+    # The plan comes from the first chunk; a later chunk of a category column
+    # that pandas read as numbers is turned back into text, so every chunk
+    # has string categories
+    for col, kind in plan.items():
+        s = chunk[col]
+        if kind == 'category':
+            chunk[col] = (s if _is_text(s) else _as_text(s)).astype('category')
+        elif kind == 'integer' and pd.api.types.is_integer_dtype(s):
+            chunk[col] = pd.to_numeric(s, downcast='integer')
+        elif kind == 'float' and pd.api.types.is_float_dtype(s):
+            chunk[col] = pd.to_numeric(s, downcast='float')
+    return chunk
+
+
+def _concat_column(parts):
+    # One column from its parts, the chunks of a file or the files of a
+    # dataset. A column that is text in some parts and numbers in others (a
+    # later chunk that did not fit the plan, or files that disagree) is
+    # written as text throughout, so it never ends up mixing types.
+    # Parts with no values (a column a file lacks) do not decide the type
+    if len({_is_text(p) for p in parts if p.notna().any()}) > 1:
+        parts = [p if _is_text(p) else _as_text(p) for p in parts]
+    if all(isinstance(p.dtype, pd.CategoricalDtype) for p in parts):
+        return union_categoricals([p.values for p in parts], ignore_order=True)
+    return pd.concat(parts).values
+
+
+def read_csv_compact(source, dropna=True, chunksize=CHUNKSIZE, **options):
+    # Read a csv in chunks, shrinking every chunk to the dtypes inferred from
+    # the first one. Columns are stitched together one at a time so the peak
+    # memory is the compact frame plus a single column, not two full copies.
+    default_bytes = 0
+    columns = None
+    plan = None
+    parts = {}
+    indexes = []
+
+    for chunk in pd.read_csv(source, chunksize=chunksize, **options):
+        if dropna:
+            chunk.dropna(inplace=True)
+        default_bytes += chunk.memory_usage(index=True, deep=True).sum()
+        if plan is None:
+            columns = list(chunk.columns)
+            plan = infer_dtypes(chunk)
+            parts = {col: [] for col in columns}
+        chunk = _compact(chunk, plan)
+        indexes.append(chunk.index)
+        for col in columns:
+            parts[col].append(chunk[col])
+        del chunk
+
+    if columns is None:
+        df = pd.read_csv(_rewind(source), nrows=0, **options)
+        return df, {'rows': 0, 'columns': len(df.columns), 'bytes': 0, 'default_bytes': 0}
+
+    df = pd.DataFrame(index=indexes[0].append(indexes[1:]))
+    del indexes
+    for col in columns:
+        df[col] = _concat_column(parts.pop(col))
+
+    info = {'rows': len(df),
+            'columns': len(df.columns),
+            'bytes': int(df.memory_usage(index=True, deep=True).sum()),
+            'default_bytes': int(default_bytes)}
+    return df, info
+
+
+SAMPLE_MAX_ROWS = 10_000_000
+
+
+def _weighted_choice(rng, values, weights, n):
+    # Categorical column drawn with the given weights, stored as category codes
+    p = np.asarray(weights, dtype=float)
+    codes = rng.choice(len(values), size=n, p=p / p.sum())
+    categories = list(dict.fromkeys(values))
+    remap = np.array([categories.index(v) for v in values], dtype=np.int8)
+    return pd.Categorical.from_codes(remap[codes], categories=categories)
+
+
+def make_sample_dataset(n=100, seed=1):
+    # Bank customer sample data, generated with vectorized numpy draws so it
+    # can double as a load-test dataset of up to SAMPLE_MAX_ROWS rows
+    n = int(min(max(n, 1), SAMPLE_MAX_ROWS))
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('2021-01-01')
+    days = (np.datetime64('2021-03-31') - start).astype(int) + 1
+
+    df = pd.DataFrame(index=pd.RangeIndex(n))
+    df['date'] = start + rng.integers(0, days, n).astype('timedelta64[D]')
+    df['date'] = df['date'].astype('datetime64[ns]')
+    df['branch'] = rng.integers(1, 6, n).astype(np.int8)
+    df['gender'] = _weighted_choice(rng, ['Male', 'Female'], [1, 1], n)
+    df['status'] = _weighted_choice(rng, ['Single', 'Married', 'Widow'], [0.2, 0.7, 0.1], n)
+    df['job'] = _weighted_choice(rng, ['Employed', 'Business', 'OFW', 'Retired', 'OFW'], [0.5, 0.1, 0.1, 0.05, 0.25], n)
+    df['salary'] = rng.normal(30000, 5000, n)
+    df['balance'] = rng.normal(50000, 2000, n)
+    df['percentage'] = rng.normal(.025, .0001, n) / 100
+    return df
+
+
+def sample_dataset(n=100, seed=1):
+    # Built on first use and shared by every session
+    return dataset_cache.get_or_compute(('sample', int(n), seed), lambda: make_sample_dataset(n, seed))
+
+
+def _arrow_input(source):
+    # Files on disk are memory-mapped, uploads are wrapped without a copy
+    import pyarrow as pa
+    if isinstance(source, str):
+        return pa.memory_map(source, 'r')
+    return pa.BufferReader(pa.py_buffer(source.getbuffer()))
+
+
+def read_arrow_table(source, fmt, columns=None, nrows=None):
+    # Read a Parquet / Feather / Arrow IPC source with the column projection
+    # pushed into the reader, so unselected columns are never decoded
+    import pyarrow as pa
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(_arrow_input(source))
+        if nrows is not None:
+            batch = next(pf.iter_batches(batch_size=nrows, columns=columns), None)
+            return pa.Table.from_batches([batch]) if batch is not None else pf.schema_arrow.empty_table()
+        return pf.read(columns=columns)
+
+    if fmt == 'arrows':
+        reader = pa.ipc.open_stream(_arrow_input(source))
+        if nrows is not None:
+            batch = next(iter(reader), None)
+            table = pa.Table.from_batches([batch]) if batch is not None else reader.schema.empty_table()
+        else:
+            table = reader.read_all()
+        return (table.select(columns) if columns is not None else table).slice(0, nrows)
+
+    # Feather v2 is the Arrow IPC file format; batches are sliced out of the
+    # memory map, so selecting columns after opening the file is free
+    import pyarrow.feather as feather
+    table = feather.read_table(_arrow_input(source), columns=columns, memory_map=True)
+    return table.slice(0, nrows)
+
+
+def iter_chunks(source, usecols=None, dropna=True, chunksize=CHUNKSIZE):
+    # Yield a dataset as pandas frames of at most chunksize rows, for the
+    # paths that never hold the whole dataset in memory
+    usecols = _file_usecols(source, usecols)
+    fmt = file_format(source)
+    if fmt == 'csv':
+        with open_csv(source) as f:
+            chunks = pd.read_csv(f, chunksize=chunksize, usecols=usecols)
+            for chunk in chunks:
+                yield chunk.dropna() if dropna else chunk
+        return
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(_arrow_input(source)).iter_batches(batch_size=chunksize, columns=usecols)
+    else:
+        batches = read_arrow_table(source, fmt, columns=usecols).to_batches(max_chunksize=chunksize)
+    for batch in batches:
+        chunk = batch.to_pandas()
+        yield chunk.dropna() if dropna else chunk
+
+
+def read_arrow_frame(source, fmt, dropna=True, columns=None):
+    table = read_arrow_table(source, fmt, columns=columns)
+    # Numeric columns without nulls are converted to pandas without copying;
+    # skip dropna entirely when arrow's null counts say there is nothing to drop
+    df = table.to_pandas(split_blocks=True)
+    if dropna and any(c.null_count for c in table.columns):
+        df.dropna(inplace=True)
+    info = {'rows': len(df),
+            'columns': len(df.columns),
+            'bytes': int(df.memory_usage(index=True, deep=True).sum())}
+    return df, info
+
+
+def peek_dataset(source, nrows=1000, **options):
+    # Header and the first rows of a dataset, used to choose the columns to
+    # load before the whole file is parsed
+    fmt = file_format(source)
+    key = ('head', fmt, fingerprint(source), nrows, _options_key(options))
+
+    def parse():
+        if fmt == 'csv':
+            with open_csv(source) as f:
+                return pd.read_csv(f, nrows=nrows, **options)
+        return read_arrow_table(source, fmt, nrows=nrows).to_pandas()
+
+    return dataset_cache.get_or_compute(key, parse)
+
+
+def parse_dataset(source, dropna=True, usecols=None, **options):
+    if file_format(source) == 'csv':
+        with open_csv(source) as f:
+            return read_csv_compact(f, dropna=dropna, usecols=usecols, **options)
+    return read_arrow_frame(source, file_format(source), dropna=dropna, columns=usecols)
+
+
+def _file_usecols(source, usecols):
+    # Readers return columns in file order, so the cache key ignores selection
+    # order; columns a file does not have are left out for that file
+    if usecols is None:
+        return None
+    wanted = set(usecols)
+    return [c for c in peek_dataset(source).columns if c in wanted]
+
+
+def load_dataset(source, dropna=True, usecols=None, **options):
+    # Parse a dataset once per distinct content, columns and parse options.
+    # Returns (frame, load info); the frame is shared between sessions and
+    # must not be modified.
+    usecols = _file_usecols(source, usecols)
+    key = ('data', file_format(source), fingerprint(source), dropna, repr(usecols), _options_key(options))
+    return dataset_cache.get_or_compute(key, lambda: parse_dataset(source, dropna, usecols, **options))
+
+
+SOURCE_COLUMN = 'source_file'
+_pool = None
+
+
+def _reader_pool():
+    # One pool for the lifetime of the server. Workers are spawned rather than
+    # forked because the streamlit server process is multi-threaded.
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _parse_in_worker(source, dropna, usecols, options):
+    if isinstance(source, tuple):
+        source = NamedBytesIO(*source)
+    return parse_dataset(source, dropna, usecols, **options)
+
+
+def source_labels(names):
+    # One distinct label per file: the path below the folder the files have
+    # in common (so a/2026-10-01.csv and b/2026-10-01.csv stay apart), and a
+    # counter for names that still repeat, such as two uploads of data.csv
+    folders = [os.path.dirname(n) for n in names]
+    try:
+        common = os.path.commonpath(folders) if all(folders) else ''
+    except ValueError:
+        common = ''
+    labels = [os.path.relpath(n, common) if common else os.path.basename(n) for n in names]
+    seen = {}
+    for i, label in enumerate(labels):
+        seen[label] = seen.get(label, 0) + 1
+        if seen[label] > 1:
+            labels[i] = f'{label} ({seen[label]})'
+    return labels
+
+
+def source_column(columns):
+    # SOURCE_COLUMN, or a numbered variant when the data has such a column
+    name, i = SOURCE_COLUMN, 1
+    while name in columns:
+        name, i = f'{SOURCE_COLUMN}_{i}', i + 1
+    return name
+
+
+def concat_frames(frames, names, dropna=True):
+    # Stack partitions into one frame. Every column is merged as the chunks of
+    # a file are (see _concat_column), so it has one dtype across the files,
+    # and a categorical column records the file each row came from. A column
+    # missing from some files is filled with NaN, unless NaN rows are dropped:
+    # then only the columns every file has are kept, as filling them would
+    # bring back exactly the rows dropna removed. Returns the frame and the
+    # columns left out.
+    columns = list(dict.fromkeys(col for df in frames for col in df.columns))
+    skipped = []
+    if dropna:
+        skipped = [col for col in columns if not all(col in df.columns for df in frames)]
+        columns = [col for col in columns if col not in skipped]
+    lengths = [len(df) for df in frames]
+    out = pd.DataFrame(index=pd.RangeIndex(sum(lengths)))
+    for col in columns:
+        parts = [df[col].reset_index(drop=True) if col in df.columns else pd.Series(np.nan, index=range(len(df)))
+                 for df in frames]
+        out[col] = _concat_column(parts)
+    out[source_column(out.columns)] = pd.Categorical.from_codes(np.repeat(np.arange(len(frames)), lengths),
+                                                                categories=source_labels(names))
+    return out, skipped
+
+
+def load_datasets(sources, dropna=True, usecols=None, **options):
+    # Load one or more partitions of a dataset. Several files are parsed
+    # concurrently in the reader pool and concatenated into one frame.
+    if len(sources) == 1:
+        return load_dataset(sources[0], dropna=dropna, usecols=usecols, **options)
+
+    file_usecols = [_file_usecols(s, usecols) for s in sources]
+    key = ('multi', tuple(fingerprint(s) for s in sources), dropna, repr(file_usecols), _options_key(options))
+
+    def parse():
+        jobs = [s if isinstance(s, str) else (s.getvalue(), source_name(s)) for s in sources]
+        pool = _reader_pool()
+        futures = [pool.submit(_parse_in_worker, job, dropna, cols, options) for job, cols in zip(jobs, file_usecols)]
+        del jobs
+        results = [f.result() for f in futures]
+        df, skipped = concat_frames([r[0] for r in results], [source_name(s) for s in sources], dropna)
+        default_bytes = sum(r[1].get('default_bytes', r[1]['bytes']) for r in results)
+        del results
+        info = {'rows': len(df),
+                'columns': len(df.columns),
+                'files': len(sources),
+                'bytes': int(df.memory_usage(index=True, deep=True).sum()),
+                'default_bytes': int(default_bytes)}
+        if skipped:
+            info['skipped_columns'] = skipped
+        return df, info
+
+    return dataset_cache.get_or_compute(key, parse)
@@ -2,12 +2,31 @@
 import pandas as pd
 import numpy as np
 import streamlit as st
-import random
 import datetime as dt
 import plotly.express as px
 import warnings
+import os
+from sqlstore import build_store, SAMPLE_ROWS, AGGREGATES as STORE_AGGREGATES
+from stats import column_profile, approx_describe, correlation_ranking, CORRELATION_METHODS
+from preview import row_order, page
+from aggregate import group_agg, fold_plan, folded_caption, AGGREGATES, TOP_N
+from downsample import downsample_series, METHODS as DOWNSAMPLE_METHODS
+from raster import rasterize, value_range
+from polar import polar_bins, SECTORS, RANGES, RANGE_COLUMN
+from geobin import geo_bins, SHAPES as GEO_SHAPES, SCOPES as GEO_SCOPES, CELLS as GEO_CELLS
+from summaries import distribution_summary, summarize_distributions, OUTLIER_CAP
+from sampling import stratified_sample, sample_strata, sample_caption, SAMPLE_SIZE
+from hierarchy import hierarchy_index, subtree, drill_targets, node_path, MAX_CHILDREN
+from binning import histogram, histogram2d, kde2d, xbins, summarize_marginals, summarize_binned_marginals, GROUP_COLUMN, NBINS, MAX_BINS, KDE_GRID
+from figures import figure_key, show_figure, show_cached_figure, show_last_figure, ChartNotes
+from loader import load_datasets, peek_dataset, sample_dataset, SAMPLE_MAX_ROWS, list_data_files, glob_data_files, format_bytes, DATASET_TYPES
 warnings.filterwarnings('ignore')
 
+# Scatter plots with more rows than this are drawn with WebGL instead of SVG
+WEBGL_ROWS = int(os.environ.get('PEDAL_WEBGL_ROWS', 50_000))
+# A scatter matrix grows with the square of its dimensions
+MATRIX_MAX_DIMENSIONS = 6
+
 rad = st.sidebar.radio('Pages', ['About PEDAL','Visualization', 'Types of Graphs'])
 
 if rad == 'About PEDAL':
@@ -36,61 +55,101 @@ if rad == 'About PEDAL':
 
 if rad == 'Visualization':
 
-    # Dummy Dataset
-    random.seed(1)
-
-    my_date = list(pd.date_range(start='01-01-2021', end='03-31-2021'))
-    my_branch = [1,2,3,4,5]
-    my_gender = ['Male','Female']
-    my_status = ['Single','Married','Widow']
-    my_status_wts = [0.2, 0.7, 0.1]
-    my_job =  ['Employed','Business','OFW','Retired','OFW']
-    my_job_wts = [0.5,0.1,0.1, 0.05, 0.25]
-
-    n = 100
-    salary = np.random.normal(30000,5000, n)
-    balance = np.random.normal(50000,2000, n)
-    percentage = np.random.normal(.025, .0001, n)
-
-    df = pd.DataFrame()
-    df['date'] = random.choices(my_date, k=n)
-    df['date'] = df['date'].dt.date
-    df['branch'] = random.choices(my_branch, k=n)
-    df['gender'] = random.choices(my_gender, k=n)
-    df['status'] = random.choices(my_status, k=n, weights=my_status_wts)
-    df['job'] = random.choices(my_job, k=n, weights=my_job_wts)
-    df['salary'] = salary
-    df['balance'] = balance
-    df['percentage'] = percentage
-    df['percentage'] = df['percentage']/100
-    df.dropna(inplace=True)
-
-
     # Dataset Upload
     st.header('Upload Dataset')
-    st.markdown("""You can upload your own dataset (in csv format) for visualization by clicking the
-    ***Browse files*** button below. Note that NaNs will be automatically dropped in order to visualize the data.
+    st.markdown("""You can upload your own dataset (in csv, parquet, feather or arrow format; csv files may be compressed as .gz, .zip, .bz2 or .xz) for visualization by clicking the
+    ***Browse files*** button below. Several files (e.g. daily partitions) can be selected at once and are combined
+    into one dataset, with a source_file column recording where each row came from. Note that NaNs will be automatically dropped in order to visualize the data.
     In the absence of your own dataset, a sample dataset is also provided belows
     so you can tinker with the app's visualization capabilities.""")
 
-    df1 = st.file_uploader('Upload csv:', type='csv')
+    df1 = st.file_uploader('Upload dataset:', type=DATASET_TYPES, accept_multiple_files=True)
 
+    # Files already on the server are memory-mapped instead of uploaded
+    data_dir = os.environ.get('PEDAL_DATA_DIR')
+    if not df1 and data_dir:
+        server_files = st.multiselect('Or open files on the server:', list_data_files(data_dir), key='sf_up')
+        server_glob = st.text_input('Or a glob pattern for files on the server (e.g. sales/2026-10-*.csv):', key='sg_up')
+        server_files = list(dict.fromkeys(server_files + glob_data_files(data_dir, server_glob)))
+        df1 = [os.path.join(data_dir, f) for f in server_files]
 
-    # Drop NA if any
+
+    # Drop NA if any (parsed once per file content, see loader.load_datasets)
     if df1:
-        df1 = pd.read_csv(df1)
-        df1.dropna(inplace=True)
+        # Only the header and a sample are read until the working columns are chosen
+        df1_head = peek_dataset(df1[0])
+        head_cols = list(df1_head.columns)
+        use_cols = st.multiselect('Select the columns to load:', head_cols,
+                                  default=head_cols if len(head_cols) <= 30 else None, key='uc_up')
+        if not use_cols:
+            st.info(f'The file has {len(head_cols)} columns. Select the columns you need for your graphs; '
+                    'only these columns will be read from the file.')
+            st.dataframe(df1_head.head(20))
+            st.stop()
+
+        # Out-of-core: the data stays on disk in SQLite and the graphs query aggregates from it
+        store = None
+        if st.checkbox('Out-of-core mode: keep the dataset on disk (SQLite) and only load the aggregates each graph needs',
+                       key='ooc_up'):
+            store = build_store(df1, usecols=use_cols)
+            df1 = store.sample(SAMPLE_ROWS)
+            st.caption(f'{store.rows:,} rows stored on disk. Bar, Pie, Sunburst, Treemap, Histogram and Density Heatmap '
+                       f'are aggregated in SQLite; the preview and the other graphs use a random sample of {len(df1):,} rows.')
+        else:
+            df1, load_info = load_datasets(df1, usecols=use_cols)
+            load_msg = f"Loaded {load_info.get('files', 1)} file(s), {load_info['rows']:,} rows x {load_info['columns']} columns ({format_bytes(load_info['bytes'])} in memory"
+            if 'default_bytes' in load_info:
+                load_msg += f", {format_bytes(load_info['default_bytes'])} with default dtypes"
+            st.caption(load_msg + ').')
+            if load_info.get('skipped_columns'):
+                st.caption(f"Left out because some files do not have them: {', '.join(map(str, load_info['skipped_columns']))}.")
     else:
-        df1=df
-
-
-    st.dataframe(df1)
+        # Dummy Dataset (only generated when no file is given, see loader.make_sample_dataset)
+        n = st.number_input('Number of rows in the sample dataset:', min_value=100, max_value=SAMPLE_MAX_ROWS,
+                            value=100, step=1000, key='n_up')
+        df1 = sample_dataset(n)
+        store = None
+
+
+    # Column profile: computed once per dataset, read by the statistics table and the sidebar widgets
+    profile = column_profile(df1)
+
+    # Data preview: only the current page is sent to the browser
+    pv_cols = st.columns(4)
+    pv_sort = pv_cols[0].selectbox('Sort by:', [None] + profile.columns, key='sort_pv')
+    pv_ascending = pv_cols[1].selectbox('Order:', ['ascending', 'descending'], key='order_pv') == 'ascending'
+    pv_size = pv_cols[2].selectbox('Rows per page:', [20, 50, 100, 500], index=1, key='size_pv')
+    pv_query = st.text_input('Filter rows (e.g. salary > 30000 and gender == "Male"; quote column names with spaces '
+                             'in backticks):', key='filter_pv')
+    try:
+        pv_rows = row_order(df1, pv_query.strip(), pv_sort, pv_ascending)
+    except Exception as e:
+        st.error(f'Invalid filter: {e}')
+        pv_rows = row_order(df1, '', pv_sort, pv_ascending)
+    pv_pages = max(1, -(-len(pv_rows) // pv_size))
+    pv_page = pv_cols[3].number_input(f'Page (of {pv_pages:,}):', min_value=1, max_value=pv_pages, value=1, key='page_pv')
+    st.dataframe(page(df1, pv_rows, pv_page, pv_size))
+    pv_total = f'{store.rows:,} rows on disk; previewing a sample of {profile.rows:,} rows' if store is not None \
+        else f'{profile.rows:,} rows, {format_bytes(profile.nbytes)} in memory'
+    st.caption(f'{pv_total}. {len(pv_rows):,} rows match the filter, showing page {pv_page:,} of {pv_pages:,}.')
 
     st.header('Descriptive Statistics')
     st.markdown("""The following is the descriptive statistics for the dataset's numeric features:""")
 
-    num_col = df1.select_dtypes(include='number').columns
-    st.write(df1[num_col].describe())
+    num_col = profile.numeric
+    if st.checkbox('Approximate statistics (one pass with sketches, faster on very large data)', key='as_ds'):
+        st.write(approx_describe(df1 if store is None else None, store=store))
+        st.caption('Quartiles come from a t-digest and distinct counts from HyperLogLog; every column, '
+                   'categorical ones included, gets a distinct count. The error rows give the bound '
+                   'for each estimate: quartile error in percentile points, distinct count error as a '
+                   'standard error.')
+    elif store is None:
+        st.write(profile.describe)
+    else:
+        st.write(store.describe(num_col))
+
+    with st.expander('Column profile'):
+        st.write(profile.table.astype({'min': str, 'max': str}))
 
 
     # Visualization
@@ -122,9 +181,12 @@ if rad == 'Visualization':
                                                  'Polar (Scatter)','Scatter','Scatter Geo','Scatter Matrix','Strip',
                                                  'Sunburst','Treemap','Violin'])
 
-    col_all = list(df1.columns)
+    col_all = list(profile.columns)
     col_all.insert(0, None)
 
+    # Aggregates for the pre-aggregated charts (SQLite has no median)
+    agg_options = AGGREGATES if store is None else [a for a in AGGREGATES if a in STORE_AGGREGATES]
+
 
     # Scatter Plot
     if rad == 'Scatter':
@@ -141,14 +203,28 @@ if rad == 'Visualization':
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc_sp')
         facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='sl_sp')
-        marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx_sp')
-        marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx_sp')
-        trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx_sp')
+        marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin', None], key='mx_sp')
+        marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin', None], key='my_sp')
+        trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='tl_sp')
+        render_mode = st.sidebar.selectbox('Render mode:', ['auto', 'webgl', 'svg', 'rasterize'], key='rm_sp')
+        if render_mode == 'rasterize':
+            # The points are binned on the server; zooming re-bins the chosen window
+            raster_value = st.sidebar.selectbox('Pixel value:', ['count', 'mean of color', 'max of size'], key='rv_sp')
+            raster_width = st.sidebar.number_input('Image width in pixels:', min_value=100, max_value=2000, value=600, step=100, key='rw_sp')
+            raster_source = df1 if store is None else store
+            raster_ranges = []
+            for axis, col in [('x', x), ('y', y)]:
+                lo, hi = value_range(raster_source, col) if col in profile.numeric else (None, None)
+                if lo is not None and hi > lo:
+                    lo, hi = float(lo), float(hi)
+                    raster_ranges.append(st.sidebar.slider(f'Zoom {axis}-axis:', lo, hi, (lo, hi), key=f'r{axis}_sp'))
+                else:
+                    raster_ranges.append(None)
 
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
+            my_col_order = profile.unique_values(facet_col)
             facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order, key='fo_sc')
             facet_order2 = {facet_col: facet_order}
 
@@ -161,27 +237,61 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"],key='te_sc')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['x_sp', 'y_sp', 'color_sp', 'size_sp', 'fc_sp', 'sl_sp', 'mx_sp', 'my_sp', 'tl_sp',
+                                'rm_sp', 'rv_sp', 'rw_sp', 'rx_sp', 'ry_sp', 'fo_sc', 't_sc', 'te_sc'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.scatter(df1, x=x, y=y,
-                             color=color,
-                             size=size,
-                             facet_col=facet_col,
-                             facet_col_wrap=facet_col_wrap,
-                             category_orders=facet_order2,
-                             marginal_x=marginal_x,
-                             marginal_y=marginal_y,
-                             trendline=trendline,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if render_mode == 'rasterize':
+                    raster_agg, raster_col = {'count': ('count', None), 'mean of color': ('mean', color), 'max of size': ('max', size)}[raster_value]
+                    if x not in profile.numeric or y not in profile.numeric or (raster_agg != 'count' and raster_col not in profile.numeric):
+                        st.error(f'Rasterize mode needs numeric x and y columns, and a numeric column for the {raster_value}.')
+                        st.stop()
+                    if facet_col or marginal_x or marginal_y or trendline:
+                        notes.caption('Facets, marginals and the trendline are not drawn in rasterize mode.')
+
+                    image, xs, ys = rasterize(raster_source, x, y, raster_col, raster_agg,
+                                              raster_width, raster_width * 2 // 3, *raster_ranges)
+                    # Point density spans orders of magnitude, so counts are shown on a log scale
+                    if raster_agg == 'count':
+                        image, label = np.log10(image), 'log10(count)'
+                    else:
+                        label = f'{raster_agg} of {raster_col}'
+                    fig = px.imshow(image, x=xs, y=ys, origin='lower', aspect='auto',
+                                    labels={'x': x, 'y': y, 'color': label},
+                                    template=template)
+                else:
+                    # SVG draws one DOM node per point; WebGL stays interactive into the millions
+                    if render_mode == 'auto':
+                        render_mode = 'webgl' if len(df1) > WEBGL_ROWS else 'svg'
+                    if render_mode == 'webgl' and (marginal_x or marginal_y):
+                        notes.warning(f'Marginal {marginal_x or marginal_y} plots are not drawn with WebGL: they are built in the browser '
+                                   f'from all {len(df1):,} rows as SVG. Set the marginals to None if the graph is slow.')
+                    if render_mode == 'svg' and len(df1) > WEBGL_ROWS:
+                        notes.warning(f'Drawing {len(df1):,} points as SVG may make the browser unresponsive. Use auto or webgl render mode.')
+
+                    fig = px.scatter(df1, x=x, y=y,
+                                     color=color,
+                                     size=size,
+                                     facet_col=facet_col,
+                                     facet_col_wrap=facet_col_wrap,
+                                     category_orders=facet_order2,
+                                     marginal_x=marginal_x,
+                                     marginal_y=marginal_y,
+                                     trendline=trendline,
+                                     render_mode=render_mode,
+                                     template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Bar Plot
@@ -190,6 +300,8 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Dimensions:')
         x = st.sidebar.selectbox('x-axis:', col_all, key='x_bp')
         y = st.sidebar.selectbox('y-axis:', col_all, key='y_bp')
+        agg = st.sidebar.selectbox('Aggregate y by:', agg_options, key='agg_bp')
+        top_n = st.sidebar.number_input('Categories to show (the rest are grouped as Other):', min_value=1, max_value=1000, value=TOP_N, key='tn_bp')
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color_bp')
@@ -205,13 +317,13 @@ if rad == 'Visualization':
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
+            my_col_order = profile.unique_values(facet_col)
             facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order, key='fo_bp')
             facet_order2 = {facet_col: facet_order}
 
         #hline and vline:
         y_hline = st.sidebar.number_input('Select value of horizontal line', value=0, key='hl_bp')
-        annotation_text = st.sidebar.text_input('Type comments for horizontal line:', value='', key='hl_bp')
+        annotation_text = st.sidebar.text_input('Type comments for horizontal line:', value='', key='at_bp')
         annotation_position = st.sidebar.selectbox('Select position of horizontal line comment:', [None, 'top left', 'bottom right'], key='ap_bp')
 
         st.sidebar.markdown('Define Labels and Theme:')
@@ -222,33 +334,50 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_bp')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['x_bp', 'y_bp', 'agg_bp', 'tn_bp', 'color_bp', 'fc_bp', 'fw_bp', 'bm_bp', 'fo_bp',
+                                'hl_bp', 'at_bp', 'ap_bp', 't_bp', 'te_bp'])
         if st.sidebar.button('Click to generate graph', key='b_bp'):
-            fig = px.bar(df1, x=x, y=y,
-                             color=color,
-                             # size=size,
-                             facet_col=facet_col,
-                             facet_col_wrap=facet_col_wrap,
-                             category_orders=facet_order2,
-                             barmode=barmode,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-
-            fig.add_hline(y=y_hline,
-                          line_dash="dot",
-                          annotation_text=annotation_text,
-                          annotation_position=annotation_position)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                # One bar segment per group instead of one per row, and only the
+                # largest categories of x, color and facet get their own
+                bar_keep, bar_folded = fold_plan(df1 if store is None else store, [x, color, facet_col], y, agg, top_n)
+                if store is None:
+                    bar_data = group_agg(df1, [x, color, facet_col], y, agg, keep=bar_keep)
+                else:
+                    bar_data = store.group_agg([x, color, facet_col], y, agg, keep=bar_keep)
+                if bar_folded:
+                    notes.caption(folded_caption(bar_folded))
+                bar_y = bar_data.columns[-1]
+
+                fig = px.bar(bar_data, x=x, y=bar_y,
+                                 labels={bar_y: f'{agg} of {y}' if y else 'count'},
+                                 color=color,
+                                 # size=size,
+                                 facet_col=facet_col,
+                                 facet_col_wrap=facet_col_wrap,
+                                 category_orders=facet_order2,
+                                 barmode=barmode,
+                                 template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+
+                fig.add_hline(y=y_hline,
+                              line_dash="dot",
+                              annotation_text=annotation_text,
+                              annotation_position=annotation_position)
+
+                show_figure(rad, chart_key, fig, notes)
 
 
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Line Plot
@@ -265,13 +394,17 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc_ln')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fc_ln')
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_ln')
         line_group = st.sidebar.selectbox('Select Line Groupings:', col_all, key='lg_ln')
 
+        st.sidebar.markdown('Downsampling:')
+        ds_method = st.sidebar.selectbox('Downsampling method:', DOWNSAMPLE_METHODS + [None], key='ds_ln')
+        ds_points = st.sidebar.number_input('Maximum points per line:', min_value=100, max_value=100000, value=2000, step=500, key='dp_ln')
+
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
+            my_col_order = profile.unique_values(facet_col)
             facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order, key='fo_ln')
             facet_order2 = {facet_col: facet_order}
 
@@ -285,48 +418,72 @@ if rad == 'Visualization':
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
-        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='t_ln')
+        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_ln')
 
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['x_ln', 'y_ln', 'color_ln', 'fc_ln', 'fw_ln', 'lg_ln', 'ds_ln', 'dp_ln', 'fo_ln',
+                                'hl_ln', 'at_ln', 'ap_ln', 't_ln', 'te_ln'])
         if st.sidebar.button('Click to generate graph', key='b_ln'):
-            fig = px.line(df1, x=x, y=y,
-                             color=color,
-                             # size=size,
-                             facet_col=facet_col,
-                             facet_col_wrap=facet_col_wrap,
-                             category_orders=facet_order2,
-                             template=template,
-                             line_group=line_group)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-
-            fig.add_hline(y=y_hline,
-                          line_dash="dot",
-                          annotation_text=annotation_text,
-                          annotation_position=annotation_position)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                # Each color / line group / facet series is reduced to at most ds_points points
+                line_data = df1
+                if ds_method is not None and x is not None and y is not None:
+                    line_data, (ds_in, ds_out, ds_series) = downsample_series(df1, x, y, [color, line_group, facet_col], ds_points, ds_method)
+                    if ds_out < ds_in:
+                        notes.caption(f'Downsampled with {ds_method}: {ds_in:,} points reduced to {ds_out:,} across {ds_series:,} line(s).')
+
+                fig = px.line(line_data, x=x, y=y,
+                                 color=color,
+                                 # size=size,
+                                 facet_col=facet_col,
+                                 facet_col_wrap=facet_col_wrap,
+                                 category_orders=facet_order2,
+                                 template=template,
+                                 line_group=line_group)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+
+                fig.add_hline(y=y_hline,
+                              line_dash="dot",
+                              annotation_text=annotation_text,
+                              annotation_position=annotation_position)
+
+                show_figure(rad, chart_key, fig, notes)
 
 
         else:
-            pass
+            show_last_figure(rad)
 
     # Scatter Matrix
     if rad == 'Scatter Matrix':
 
         st.sidebar.markdown('Select Dimensions:')
-        dimensions = st.sidebar.multiselect('Dimensions (select numeric only):', col_all, key='dim_sm')
+        # Column pairs ranked by correlation, so the strongest ones are offered first
+        corr_method = st.sidebar.selectbox('Rank column pairs by:', CORRELATION_METHODS, key='cm_sm')
+        corr_matrix, corr_pairs = correlation_ranking(df1, profile.numeric, corr_method)
+        top_dimensions = list(dict.fromkeys(corr_pairs[['column 1', 'column 2']].to_numpy().ravel()))[:4]
+        dimensions = st.sidebar.multiselect('Dimensions (select numeric only):', col_all, default=top_dimensions, key='dim_sm')
+        if len(corr_pairs):
+            with st.expander(f'Column pairs ranked by {corr_method} correlation'):
+                st.dataframe(corr_pairs.head(20))
+                st.plotly_chart(px.imshow(corr_matrix, zmin=-1, zmax=1, color_continuous_scale='RdBu'))
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color_sm')
         size = st.sidebar.selectbox('Size:', col_all, key='size_sm')
 
+        st.sidebar.markdown('Sampling:')
+        use_sample = st.sidebar.checkbox('Draw a stratified sample of the rows', value=len(df1) > SAMPLE_SIZE, key='us_sm')
+        sample_size = st.sidebar.number_input('Sample size:', min_value=1000, max_value=1000000, value=SAMPLE_SIZE, step=1000, key='ss_sm')
+
         # st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         # facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
@@ -351,27 +508,40 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_sm')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['cm_sm', 'dim_sm', 'color_sm', 'size_sm', 'us_sm', 'ss_sm', 't_sm', 'te_sm'])
         if st.sidebar.button('Click to generate graph', key='b_sm'):
-            fig = px.scatter_matrix(df1, dimensions=dimensions,
-                             color=color,
-                             size=size,
-                             # facet_col=facet_col,
-                             # facet_col_wrap=facet_col_wrap,
-                             # category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if len(dimensions) > MATRIX_MAX_DIMENSIONS:
+                    notes.warning(f'Only the first {MATRIX_MAX_DIMENSIONS} of the {len(dimensions)} dimensions are plotted: '
+                               f'a scatter matrix draws every pair, so it grows with the square of the dimensions.')
+                    dimensions = dimensions[:MATRIX_MAX_DIMENSIONS]
+                matrix_data = df1
+                if use_sample:
+                    matrix_strata = sample_strata(df1 if store is None else store, [color])
+                    matrix_data, matrix_rows = stratified_sample(df1 if store is None else store, sample_size, matrix_strata)
+                    notes.caption(sample_caption(matrix_data, matrix_rows, matrix_strata))
+                fig = px.scatter_matrix(matrix_data, dimensions=dimensions,
+                                 color=color,
+                                 size=size,
+                                 # facet_col=facet_col,
+                                 # facet_col_wrap=facet_col_wrap,
+                                 # category_orders=facet_order2,
+                                 # marginal_x=marginal_x,
+                                 # marginal_y=marginal_y,
+                                 # trendline=trendline,
+                                 template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
     # Area Plot
     if rad == 'Area':
@@ -389,7 +559,11 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc_ap')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fc_ap')
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_ap')
+
+        st.sidebar.markdown('Downsampling:')
+        ds_method = st.sidebar.selectbox('Downsampling method:', DOWNSAMPLE_METHODS + [None], key='ds_ap')
+        ds_points = st.sidebar.number_input('Maximum points per area:', min_value=100, max_value=100000, value=2000, step=500, key='dp_ap')
         # marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx')
         # marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
@@ -415,32 +589,47 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_ap')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['x_ap', 'y_ap', 'color_ap', 'fc_ap', 'fw_ap', 'ds_ap', 'dp_ap', 'hl_ap', 'at_ap',
+                                'ap_ap', 't_ap', 'te_ap'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.area(df1, x=x, y=y,
-                             color=color,
-                             # size=size,
-                             facet_col=facet_col,
-                             facet_col_wrap=facet_col_wrap,
-                             # category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             template=template)
-
-            fig.add_hline(y=y_hline,
-                          line_dash="dot",
-                          annotation_text=annotation_text,
-                          annotation_position=annotation_position)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                # Each color / facet series is reduced to at most ds_points points
+                area_data = df1
+                if ds_method is not None and x is not None and y is not None:
+                    area_data, (ds_in, ds_out, ds_series) = downsample_series(df1, x, y, [color, facet_col], ds_points, ds_method)
+                    if ds_out < ds_in:
+                        notes.caption(f'Downsampled with {ds_method}: {ds_in:,} points reduced to {ds_out:,} across {ds_series:,} series.')
+
+                fig = px.area(area_data, x=x, y=y,
+                                 color=color,
+                                 # size=size,
+                                 facet_col=facet_col,
+                                 facet_col_wrap=facet_col_wrap,
+                                 # category_orders=facet_order2,
+                                 # marginal_x=marginal_x,
+                                 # marginal_y=marginal_y,
+                                 # trendline=trendline,
+                                 template=template)
+
+                # Downsampled series no longer share x values; interpolate them when stacking
+                fig.update_traces(stackgaps='interpolate')
+
+                fig.add_hline(y=y_hline,
+                              line_dash="dot",
+                              annotation_text=annotation_text,
+                              annotation_position=annotation_position)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Pie Plot
@@ -449,6 +638,8 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Dimensions:')
         x = st.sidebar.selectbox('x-axis:', col_all, key='x_pie')
         y = st.sidebar.selectbox('y-axis:', col_all, key='y_pie')
+        agg = st.sidebar.selectbox('Aggregate y by:', agg_options, key='agg_pie')
+        top_n = st.sidebar.number_input('Categories to show (the rest are grouped as Other):', min_value=1, max_value=1000, value=TOP_N, key='tn_pie')
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color_pie')
@@ -478,27 +669,43 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_pie')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['x_pie', 'y_pie', 'agg_pie', 'tn_pie', 'color_pie', 't_pie', 'te_pie'])
         if st.sidebar.button('Click to generate graph', key='b_pie'):
-            fig = px.pie(df1, names=x, values=y,
-                             color=color,
-                             # size=size,
-                             # facet_col=facet_col,
-                             # facet_col_wrap=facet_col_wrap,
-                             # category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                # One sector per group instead of one per row, and only the
+                # largest categories get their own
+                pie_keep, pie_folded = fold_plan(df1 if store is None else store, [x, color], y, agg, top_n)
+                if store is None:
+                    pie_data = group_agg(df1, [x, color], y, agg, keep=pie_keep)
+                else:
+                    pie_data = store.group_agg([x, color], y, agg, keep=pie_keep)
+                if pie_folded:
+                    notes.caption(folded_caption(pie_folded))
+                pie_y = pie_data.columns[-1]
+
+                fig = px.pie(pie_data, names=x, values=pie_y,
+                                 labels={pie_y: f'{agg} of {y}' if y else 'count'},
+                                 color=color,
+                                 # size=size,
+                                 # facet_col=facet_col,
+                                 # facet_col_wrap=facet_col_wrap,
+                                 # category_orders=facet_order2,
+                                 # marginal_x=marginal_x,
+                                 # marginal_y=marginal_y,
+                                 # trendline=trendline,
+                                 template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -508,9 +715,30 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Dimensions:')
         path = st.sidebar.multiselect('Select Path in order:', col_all, key='path1_sun')
         y = st.sidebar.selectbox('y-axis:', col_all, key='y_sun')
+        agg = st.sidebar.selectbox('Aggregate y by:', agg_options, key='agg_sun')
+        levels = st.sidebar.number_input('Levels to show:', min_value=1, max_value=10, value=3, key='lv_sun')
+        max_children = st.sidebar.number_input('Largest sectors per parent (the rest go to Other):', min_value=1, max_value=500, value=MAX_CHILDREN, key='mc_sun')
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color_sun')
+
+        # The hierarchy is indexed once per dataset and path; drilling down
+        # and changing the depth only pick nodes out of the index
+        sun_index = None
+        if path:
+            # One row per leaf; a numeric color is averaged per leaf, weighted by y as plotly does
+            if color in profile.numeric and color not in path:
+                sun_by, sun_mean = path, [color]
+            else:
+                sun_by, sun_mean = path + [color], []
+            if store is None:
+                sun_data = group_agg(df1, sun_by, y, agg, weighted_mean=sun_mean)
+            else:
+                sun_data = store.group_agg(sun_by, y, agg, weighted_mean=sun_mean)
+            sun_y = sun_data.columns[-1]
+            sun_index = hierarchy_index(sun_data, path, sun_y, color, max_children)
+        drill = st.sidebar.selectbox('Drill into:', [None] + (drill_targets(sun_index) if sun_index is not None else []),
+                                     format_func=node_path, key='dr_sun')
         # size = st.sidebar.selectbox('Size:', col_all, key='size')
 
         # st.sidebar.markdown('Select Facet Dimension:')
@@ -537,27 +765,40 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_sun')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path1_sun', 'y_sun', 'agg_sun', 'lv_sun', 'mc_sun', 'color_sun', 'dr_sun', 't_sun',
+                                'te_sun'])
         if st.sidebar.button('Click to generate graph', key='b_sun'):
-            fig = px.sunburst(df1, path=path, values=y,
-                             color=color,
-                             # size=size,
-                             # facet_col=facet_col,
-                             # facet_col_wrap=facet_col_wrap,
-                             # category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if sun_index is None:
+                st.info('Select at least one column for the path to draw the sunburst.')
+            elif not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                sun_nodes = subtree(sun_index, drill, levels)
+                notes.caption(f'Showing {len(sun_nodes):,} of {len(sun_index):,} indexed sectors.')
+
+                fig = px.sunburst(sun_nodes, ids='id', names='label', parents='parent', values='value',
+                                 labels={'value': f'{agg} of {y}' if y else 'count', 'color': color},
+                                 color='color' if color else None,
+                                 branchvalues='total',
+                                 maxdepth=levels + (drill is not None),
+                                 # size=size,
+                                 # facet_col=facet_col,
+                                 # facet_col_wrap=facet_col_wrap,
+                                 # category_orders=facet_order2,
+                                 # marginal_x=marginal_x,
+                                 # marginal_y=marginal_y,
+                                 # trendline=trendline,
+                                 template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Treemap
@@ -566,9 +807,30 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Dimensions:')
         path = st.sidebar.multiselect('Select Path in order:', col_all, key='path2_tm')
         y = st.sidebar.selectbox('y-axis:', col_all, key='y_tm')
+        agg = st.sidebar.selectbox('Aggregate y by:', agg_options, key='agg_tm')
+        levels = st.sidebar.number_input('Levels to show:', min_value=1, max_value=10, value=3, key='lv_tm')
+        max_children = st.sidebar.number_input('Largest sectors per parent (the rest go to Other):', min_value=1, max_value=500, value=MAX_CHILDREN, key='mc_tm')
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color_tm')
+
+        # The hierarchy is indexed once per dataset and path; drilling down
+        # and changing the depth only pick nodes out of the index
+        tm_index = None
+        if path:
+            # One row per leaf; a numeric color is averaged per leaf, weighted by y as plotly does
+            if color in profile.numeric and color not in path:
+                tm_by, tm_mean = path, [color]
+            else:
+                tm_by, tm_mean = path + [color], []
+            if store is None:
+                tm_data = group_agg(df1, tm_by, y, agg, weighted_mean=tm_mean)
+            else:
+                tm_data = store.group_agg(tm_by, y, agg, weighted_mean=tm_mean)
+            tm_y = tm_data.columns[-1]
+            tm_index = hierarchy_index(tm_data, path, tm_y, color, max_children)
+        drill = st.sidebar.selectbox('Drill into:', [None] + (drill_targets(tm_index) if tm_index is not None else []),
+                                     format_func=node_path, key='dr_tm')
         # size = st.sidebar.selectbox('Size:', col_all, key='size')
 
         # st.sidebar.markdown('Select Facet Dimension:')
@@ -595,27 +857,39 @@ if rad == 'Visualization':
         template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_tm')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path2_tm', 'y_tm', 'agg_tm', 'lv_tm', 'mc_tm', 'color_tm', 'dr_tm', 't_tm', 'te_tm'])
         if st.sidebar.button('Click to generate graph', key='b_tm'):
-            fig = px.treemap(df1, path=path, values=y,
-                             color=color,
-                             # size=size,
-                             # facet_col=facet_col,
-                             # facet_col_wrap=facet_col_wrap,
-                             # category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if tm_index is None:
+                st.info('Select at least one column for the path to draw the treemap.')
+            elif not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                tm_nodes = subtree(tm_index, drill, levels)
+                notes.caption(f'Showing {len(tm_nodes):,} of {len(tm_index):,} indexed sectors.')
+
+                fig = px.treemap(tm_nodes, ids='id', names='label', parents='parent', values='value',
+                                 labels={'value': f'{agg} of {y}' if y else 'count', 'color': color},
+                                 color='color' if color else None,
+                                 branchvalues='total',
+                                 maxdepth=levels + (drill is not None),
+                                 # size=size,
+                                 # facet_col=facet_col,
+                                 # facet_col_wrap=facet_col_wrap,
+                                 # category_orders=facet_order2,
+                                 # marginal_x=marginal_x,
+                                 # marginal_y=marginal_y,
+                                 # trendline=trendline,
+                                 template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -639,46 +913,105 @@ if rad == 'Visualization':
         # marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx')
         # marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
-        marginal = st.sidebar.selectbox('Select Marginal:',['rug','box','violin'])
+        marginal = st.sidebar.selectbox('Select Marginal:',['rug','box','violin'], key='mg_hs')
+        nbins = st.sidebar.number_input('Number of bins:', min_value=1, max_value=MAX_BINS, value=NBINS, key='nb_hs')
+        bin_width = None
+        if st.sidebar.checkbox('Set the bin width instead', key='ub_hs'):
+            bin_width = st.sidebar.number_input('Bin width (days for dates):', min_value=0.001, value=1.0, format='%g', key='bw_hs')
 
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
-            facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order)
+            my_col_order = profile.unique_values(facet_col)
+            facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order, key='fo_hs')
             facet_order2 = {facet_col: facet_order}
 
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_hs')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
-        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"])
+        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_hs')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path4', 'y', 'color', 'fc', 'mg_hs', 'nb_hs', 'ub_hs', 'bw_hs', 'fo_hs', 't_hs',
+                                'te_hs'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.histogram(df1, x=x, y=y,
-                             color=color,
-                             # size=size,
-                             facet_col=facet_col,
-                             # facet_col_wrap=facet_col_wrap,
-                             category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             marginal=marginal,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                # A non-numeric y is counted, as px.histogram(histfunc='count') does
+                hist_agg = 'count' if y is not None and y not in profile.numeric else 'sum'
+                if hist_agg == 'count':
+                    notes.caption(f'{y} is not numeric, so the bars count rows.')
+                if store is None and x is not None and (x in profile.numeric or pd.api.types.is_datetime64_any_dtype(df1[x])):
+                    # Bins are counted on the server from cached sorted values, and
+                    # the box / violin marginals are drawn from summaries of them
+                    if bin_width and pd.api.types.is_datetime64_any_dtype(df1[x]):
+                        bin_width = bin_width * 86400e9
+                    hist_data, hist_edges = histogram(df1, x, y, [color, facet_col], nbins, bin_width)
+                    # Timedelta steps (dates) are compared in nanoseconds
+                    hist_step = hist_edges[1] - hist_edges[0]
+                    if bin_width and getattr(hist_step, 'value', hist_step) > bin_width * (1 + 1e-9):
+                        notes.info(f'The bin width was widened to fit the data in {MAX_BINS} bins.')
+                    fig = px.histogram(hist_data, x=x, y=y or 'count',
+                                     histfunc='sum',
+                                     color=color,
+                                     # size=size,
+                                     facet_col=facet_col,
+                                     # facet_col_wrap=facet_col_wrap,
+                                     category_orders=facet_order2,
+                                     # marginal_x=marginal_x,
+                                     # marginal_y=marginal_y,
+                                     # trendline=trendline,
+                                     marginal=marginal,
+                                     hover_data=[GROUP_COLUMN] if marginal in ('box', 'violin') else None,
+                                     template=template)
+                    fig.update_traces(xbins=xbins(hist_edges), selector=dict(type='histogram'))
+                    summarize_marginals(fig, df1, x, y, [color, facet_col])
+                elif store is None:
+                    # Categories: one pre-summed bar per category and group
+                    hist_data = group_agg(df1, [x, color, facet_col], y, hist_agg)
+                    fig = px.histogram(hist_data, x=x, y=hist_data.columns[-1],
+                                     histfunc='sum',
+                                     color=color,
+                                     facet_col=facet_col,
+                                     category_orders=facet_order2,
+                                     template=template)
+                else:
+                    # Out-of-core: bins are counted in SQLite and plotted as pre-summed bars
+                    if x in store.numeric_columns():
+                        if bin_width:
+                            lo, hi = store.min_max(x)
+                            nbins = max(int(np.ceil((hi - lo) / bin_width)), 1) if pd.notna(lo) else 1
+                            if nbins > MAX_BINS:
+                                nbins = MAX_BINS
+                                notes.info(f'The bin width was widened to fit the data in {MAX_BINS} bins.')
+                        hist_data, hist_edges = store.histogram(x, nbins, y=y, by=[color, facet_col], agg=hist_agg)
+                        hist_value = y or 'count'
+                    else:
+                        hist_data, hist_edges = store.group_agg([x, color, facet_col], y, hist_agg), None
+                        hist_value = hist_data.columns[-1]
+                    fig = px.histogram(hist_data, x=x, y=hist_value,
+                                     histfunc='sum',
+                                     color=color,
+                                     facet_col=facet_col,
+                                     category_orders=facet_order2,
+                                     template=template)
+                    if hist_edges is not None:
+                        fig.update_traces(xbins=xbins(hist_edges))
+                    notes.caption('Marginal plots are not available in out-of-core mode.')
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Box Plot
@@ -695,7 +1028,7 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1)
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_bx')
         # marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx')
         # marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
@@ -705,41 +1038,59 @@ if rad == 'Visualization':
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
-            facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order)
+            my_col_order = profile.unique_values(facet_col)
+            facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order, key='fo_bx')
             facet_order2 = {facet_col: facet_order}
 
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_bx')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
-        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"])
+        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_bx')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path5', 'y', 'color', 'fc', 'fw_bx', 'fo_bx', 't_bx', 'te_bx'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.box(df1, x=x, y=y,
-                             color=color,
-                             # size=size,
-                             facet_col=facet_col,
-                             facet_col_wrap=facet_col_wrap,
-                             category_orders=facet_order2,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             # marginal=marginal,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if y in profile.numeric:
+                    # Quartiles, whiskers and a capped set of outliers per group are
+                    # computed on the server and the boxes are drawn from them
+                    box_stats, box_grid, box_outliers = distribution_summary(df1, y, [x, color, facet_col])
+                    fig = px.box(box_grid, x=x, y=y,
+                                     color=color,
+                                     facet_col=facet_col,
+                                     facet_col_wrap=facet_col_wrap,
+                                     category_orders=facet_order2,
+                                     hover_data=[GROUP_COLUMN],
+                                     template=template)
+                    summarize_distributions(fig, box_stats, box_outliers, x, y)
+                    notes.caption(f'{int(box_stats["count"].sum()):,} rows summarised; up to {OUTLIER_CAP} outliers are shown per box.')
+                else:
+                    fig = px.box(df1, x=x, y=y,
+                                     color=color,
+                                     # size=size,
+                                     facet_col=facet_col,
+                                     facet_col_wrap=facet_col_wrap,
+                                     category_orders=facet_order2,
+                                     # marginal_x=marginal_x,
+                                     # marginal_y=marginal_y,
+                                     # trendline=trendline,
+                                     # marginal=marginal,
+                                     template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Violin Plot
@@ -756,7 +1107,7 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1)
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_vn')
         # marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx')
         # marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
@@ -766,43 +1117,62 @@ if rad == 'Visualization':
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
-            facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order)
+            my_col_order = profile.unique_values(facet_col)
+            facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:', my_col_order, key='fo_vn')
             facet_order2 = {facet_col: facet_order}
 
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_vn')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
-        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"])
+        template = st.sidebar.selectbox('Choose theme:', ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white", "none"], key='te_vn')
 
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path6', 'y', 'color', 'fc', 'fw_vn', 'fo_vn', 't_vn', 'te_vn'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.violin(df1, x=x, y=y,
-                             color=color,
-                             # size=size,
-                             facet_col=facet_col,
-                             facet_col_wrap=facet_col_wrap,
-                             category_orders=facet_order2,
-                             points='all',
-                             box=True,
-                             # marginal_x=marginal_x,
-                             # marginal_y=marginal_y,
-                             # trendline=trendline,
-                             # marginal=marginal,
-                             template=template)
-
-            fig.update_layout(
-                title=title)
-                # xaxis_title=xaxis_title,
-                # yaxis_title=yaxis_title,
-                # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if y in profile.numeric:
+                    # Each violin is drawn from a fixed grid of quantiles of its group,
+                    # with a capped set of outliers in place of every point
+                    violin_stats, violin_grid, violin_outliers = distribution_summary(df1, y, [x, color, facet_col])
+                    fig = px.violin(violin_grid, x=x, y=y,
+                                     color=color,
+                                     facet_col=facet_col,
+                                     facet_col_wrap=facet_col_wrap,
+                                     category_orders=facet_order2,
+                                     box=True,
+                                     hover_data=[GROUP_COLUMN],
+                                     template=template)
+                    summarize_distributions(fig, violin_stats, violin_outliers, x, y)
+                    notes.caption(f'{int(violin_stats["count"].sum()):,} rows summarised; up to {OUTLIER_CAP} outliers are shown per violin.')
+                else:
+                    fig = px.violin(df1, x=x, y=y,
+                                     color=color,
+                                     # size=size,
+                                     facet_col=facet_col,
+                                     facet_col_wrap=facet_col_wrap,
+                                     category_orders=facet_order2,
+                                     points='all',
+                                     box=True,
+                                     # marginal_x=marginal_x,
+                                     # marginal_y=marginal_y,
+                                     # trendline=trendline,
+                                     # marginal=marginal,
+                                     template=template)
+
+                fig.update_layout(
+                    title=title)
+                    # xaxis_title=xaxis_title,
+                    # yaxis_title=yaxis_title,
+                    # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
     # Strip Plot
     if rad == 'Strip':
@@ -818,55 +1188,71 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1)
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_st')
         # marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx')
         # marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
         # marginal = st.sidebar.selectbox('Select Marginal:',['rug','box','violin'])
         orientation = st.sidebar.selectbox('Select orientation:',['h','v'], key='or')
 
+        st.sidebar.markdown('Sampling:')
+        use_sample = st.sidebar.checkbox('Draw a stratified sample of the rows', value=len(df1) > SAMPLE_SIZE, key='us_st')
+        sample_size = st.sidebar.number_input('Sample size:', min_value=1000, max_value=1000000, value=SAMPLE_SIZE, step=1000, key='ss_st')
+
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
+            my_col_order = profile.unique_values(facet_col)
             facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:',
-                                                 my_col_order)
+                                                 my_col_order, key='fo_st')
             facet_order2 = {facet_col: facet_order}
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_st')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
         template = st.sidebar.selectbox('Choose theme:',
                                         ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white",
-                                         "none"])
+                                         "none"], key='te_st')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path7', 'y', 'color', 'fc', 'fw_st', 'or', 'us_st', 'ss_st', 'fo_st', 't_st',
+                                'te_st'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.violin(df1, x=x, y=y,
-                            color=color,
-                            # size=size,
-                            facet_col=facet_col,
-                            facet_col_wrap=facet_col_wrap,
-                            category_orders=facet_order2,
-                            # points='all',
-                            # box=True,
-                            # marginal_x=marginal_x,
-                            # marginal_y=marginal_y,
-                            # trendline=trendline,
-                            # marginal=marginal,
-                            orientation=orientation,
-                            template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                # One mark per row only works up to a point, so large datasets are
+                # drawn from a sample stratified by category, color and facet
+                strip_data = df1
+                if use_sample:
+                    strata = sample_strata(df1 if store is None else store, [x if orientation == 'v' else y, color, facet_col])
+                    strip_data, strip_rows = stratified_sample(df1 if store is None else store, sample_size, strata)
+                    notes.caption(sample_caption(strip_data, strip_rows, strata))
+                fig = px.strip(strip_data, x=x, y=y,
+                                color=color,
+                                # size=size,
+                                facet_col=facet_col,
+                                facet_col_wrap=facet_col_wrap,
+                                category_orders=facet_order2,
+                                # points='all',
+                                # box=True,
+                                # marginal_x=marginal_x,
+                                # marginal_y=marginal_y,
+                                # trendline=trendline,
+                                # marginal=marginal,
+                                orientation=orientation,
+                                template=template)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Density Contour
@@ -883,7 +1269,8 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1)
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_dc')
+        gridsize = st.sidebar.number_input('Density grid size:', min_value=32, max_value=512, value=KDE_GRID, step=32, key='gs_dc')
         # marginal_x= st.sidebar.selectbox('Select Marginal x:', ['box','violin'], key='mx')
         # marginal_y= st.sidebar.selectbox('Select Marginal y:', ['box','violin'], key='mx')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
@@ -893,45 +1280,62 @@ if rad == 'Visualization':
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
+            my_col_order = profile.unique_values(facet_col)
             facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:',
-                                                 my_col_order)
+                                                 my_col_order, key='fo_dc')
             facet_order2 = {facet_col: facet_order}
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_dc')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
         template = st.sidebar.selectbox('Choose theme:',
                                         ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white",
-                                         "none"])
+                                         "none"], key='te_dc')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path8', 'y', 'fc', 'fw_dc', 'gs_dc', 'fo_dc', 't_dc', 'te_dc'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.density_contour(df1, x=x, y=y,
-                            # color=color,
-                            # size=size,
-                            facet_col=facet_col,
-                            facet_col_wrap=facet_col_wrap,
-                            category_orders=facet_order2,
-                            # points='all',
-                            # box=True,
-                            # marginal_x=marginal_x,
-                            # marginal_y=marginal_y,
-                            # trendline=trendline,
-                            # marginal=marginal,
-                            # orientation=orientation,
-                            template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if x in profile.numeric and y in profile.numeric:
+                    # A kernel density grid per facet, computed on the server with an
+                    # FFT; plotly only draws the contours of the grid
+                    dc_data, dc_xedges, dc_yedges = kde2d(df1, x, y, [facet_col], gridsize)
+                    fig = px.density_contour(dc_data, x=x, y=y, z='density',
+                                    histfunc='sum',
+                                    facet_col=facet_col,
+                                    facet_col_wrap=facet_col_wrap,
+                                    category_orders=facet_order2,
+                                    template=template)
+                    fig.update_traces(xbins=xbins(dc_xedges), ybins=xbins(dc_yedges),
+                                      selector=dict(type='histogram2dcontour'))
+                else:
+                    fig = px.density_contour(df1, x=x, y=y,
+                                    # color=color,
+                                    # size=size,
+                                    facet_col=facet_col,
+                                    facet_col_wrap=facet_col_wrap,
+                                    category_orders=facet_order2,
+                                    # points='all',
+                                    # box=True,
+                                    # marginal_x=marginal_x,
+                                    # marginal_y=marginal_y,
+                                    # trendline=trendline,
+                                    # marginal=marginal,
+                                    # orientation=orientation,
+                                    template=template)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -949,9 +1353,10 @@ if rad == 'Visualization':
         st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
-        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1)
-        marginal_x= st.sidebar.selectbox('Select Marginal x:', ['rug','box','violin','histogram'], key='mx')
-        marginal_y= st.sidebar.selectbox('Select Marginal y:', ['rug','box','violin','histogram'], key='mx')
+        facet_col_wrap = st.sidebar.slider('Choose number of graph per facet column:', min_value=1, max_value=6, step=1, key='fw_dh')
+        marginal_x= st.sidebar.selectbox('Select Marginal x:', ['rug','box','violin','histogram'], key='mx_dh')
+        marginal_y= st.sidebar.selectbox('Select Marginal y:', ['rug','box','violin','histogram'], key='my_dh')
+        nbins = st.sidebar.number_input('Number of bins (x and y):', min_value=1, max_value=500, value=NBINS, key='nb_dh')
         # trendline = st.sidebar.selectbox('Choose Trendline:', [None,'ols'], key='mx')
         # marginal = st.sidebar.selectbox('Select Marginal:',['rug','box','violin'])
         # orientation = st.sidebar.selectbox('Select orientation:',['h','v'], key='or')
@@ -959,45 +1364,69 @@ if rad == 'Visualization':
         if facet_col is None:
             facet_order2 = None
         else:
-            my_col_order = df1[facet_col].unique()
+            my_col_order = profile.unique_values(facet_col)
             facet_order = st.sidebar.multiselect('Click the categories in order you want it to appear in the graph:',
-                                                 my_col_order)
+                                                 my_col_order, key='fo_dh')
             facet_order2 = {facet_col: facet_order}
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_dh')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
         template = st.sidebar.selectbox('Choose theme:',
                                         ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white",
-                                         "none"])
+                                         "none"], key='te_dh')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path9', 'y_dh', 'fc', 'fw_dh', 'mx_dh', 'my_dh', 'nb_dh', 'fo_dh', 't_dh', 'te_dh'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.density_heatmap(df1, x=x, y=y,
-                            # color=color,
-                            # size=size,
-                            facet_col=facet_col,
-                            facet_col_wrap=facet_col_wrap,
-                            category_orders=facet_order2,
-                            # points='all',
-                            # box=True,
-                            marginal_x=marginal_x,
-                            marginal_y=marginal_y,
-                            # trendline=trendline,
-                            # marginal=marginal,
-                            # orientation=orientation,
-                            template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if store is None and not (x in profile.numeric and y in profile.numeric):
+                    fig = px.density_heatmap(df1, x=x, y=y,
+                                    # color=color,
+                                    # size=size,
+                                    facet_col=facet_col,
+                                    facet_col_wrap=facet_col_wrap,
+                                    category_orders=facet_order2,
+                                    # points='all',
+                                    # box=True,
+                                    marginal_x=marginal_x,
+                                    marginal_y=marginal_y,
+                                    # trendline=trendline,
+                                    # marginal=marginal,
+                                    # orientation=orientation,
+                                    template=template)
+                else:
+                    # The 2D bin counts per facet come from NumPy (or SQLite out of
+                    # core), and the marginals are summed from the same cells
+                    if store is None:
+                        dh_data, dh_xedges, dh_yedges = histogram2d(df1, x, y, [facet_col], nbins, nbins)
+                    else:
+                        dh_data, dh_xedges, dh_yedges = store.histogram2d(x, y, nbins, nbins, by=[facet_col])
+                        dh_data = dh_data.assign(**{GROUP_COLUMN: dh_data.groupby(facet_col).ngroup() if facet_col else 0})
+                    fig = px.density_heatmap(dh_data, x=x, y=y, z='count',
+                                    histfunc='sum',
+                                    facet_col=facet_col,
+                                    facet_col_wrap=facet_col_wrap,
+                                    category_orders=facet_order2,
+                                    marginal_x=marginal_x,
+                                    marginal_y=marginal_y,
+                                    hover_data=[GROUP_COLUMN],
+                                    template=template)
+                    fig.update_traces(xbins=xbins(dh_xedges), ybins=xbins(dh_yedges), selector=dict(type='histogram2d'))
+                    summarize_binned_marginals(fig, dh_data, x, y)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
     # Polar (Scatter)
@@ -1012,6 +1441,17 @@ if rad == 'Visualization':
         # size = st.sidebar.selectbox('Size:', col_all, key='size')
         symbol = st.sidebar.selectbox('Symbol:', col_all, key='symbol_ps')
 
+        st.sidebar.markdown('Sampling:')
+        use_sample = st.sidebar.checkbox('Draw a stratified sample of the rows', value=len(df1) > SAMPLE_SIZE, key='us_ps')
+        sample_size = st.sidebar.number_input('Sample size:', min_value=1000, max_value=1000000, value=SAMPLE_SIZE, step=1000, key='ss_ps')
+
+        st.sidebar.markdown('Binning:')
+        bin_polar = st.sidebar.checkbox('Bin theta into sectors and r into ranges', key='bn_ps')
+        if bin_polar:
+            sectors = st.sidebar.number_input('Sectors:', min_value=4, max_value=72, value=SECTORS, step=4, key='se_ps')
+            ranges = st.sidebar.number_input('r ranges:', min_value=2, max_value=20, value=RANGES, key='ra_ps')
+            polar_metric = st.sidebar.radio('Marker size:', ['count', 'sum of r'], key='pm_ps')
+
         # st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
         # facet_col = st.sidebar.selectbox('Facet Column:', col_all, key='fc')
@@ -1031,41 +1471,74 @@ if rad == 'Visualization':
         #     facet_order2 = {facet_col: facet_order}
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_ps')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
         template = st.sidebar.selectbox('Choose theme:',
                                         ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white",
-                                         "none"])
+                                         "none"], key='te_ps')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path10', 'y_ps', 'color_ps', 'symbol_ps', 'us_ps', 'ss_ps', 'bn_ps', 'se_ps',
+                                'ra_ps', 'pm_ps', 't_ps', 'te_ps'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.scatter_polar(df1,r=x, theta=y,
-                            color=color,
-                            # size=size,
-                            # facet_col=facet_col,
-                            # facet_col_wrap=facet_col_wrap,
-                            # category_orders=facet_order2,
-                            # points='all',
-                            # box=True,
-                            # marginal_x=marginal_x,
-                            # marginal_y=marginal_y,
-                            # trendline=trendline,
-                            # marginal=marginal,
-                            # orientation=orientation,
-                            symbol=symbol,
-                            color_discrete_sequence=px.colors.sequential.Plasma_r,
-                            template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if bin_polar:
+                    # One marker per sector and r range, sized by its row count
+                    # (or the sum of r) instead of one marker per row
+                    if x is None or y is None:
+                        st.error('Binning needs an r (x-axis) and a theta (y-axis) column.')
+                        st.stop()
+                    if polar_metric == 'sum of r' and x not in profile.numeric:
+                        st.error('Summing needs a numeric r (x-axis) column.')
+                        st.stop()
+                    polar_data, polar_ranges = polar_bins(df1 if store is None else store, x, y, [color, symbol], sectors, ranges)
+                    polar_value = 'count' if polar_metric == 'count' else f'sum of {x}'
+                    if polar_value != 'count':
+                        polar_data = polar_data.rename(columns={'sum': polar_value})
+                    notes.caption(f'{len(polar_data):,} sector and range bins drawn.')
+                    fig = px.scatter_polar(polar_data, r=RANGE_COLUMN, theta=y,
+                                           color=color if color in polar_data else polar_value,
+                                           symbol=symbol if symbol in polar_data else None,
+                                           size=polar_data[polar_value].clip(lower=0),
+                                           category_orders={RANGE_COLUMN: polar_ranges},
+                                           hover_data={'count': True},
+                                           color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                           template=template)
+                else:
+                    polar_data = df1
+                    if use_sample:
+                        polar_strata = sample_strata(df1 if store is None else store, [color, symbol])
+                        polar_data, polar_rows = stratified_sample(df1 if store is None else store, sample_size, polar_strata)
+                        notes.caption(sample_caption(polar_data, polar_rows, polar_strata))
+                    fig = px.scatter_polar(polar_data,r=x, theta=y,
+                                    color=color,
+                                    # size=size,
+                                    # facet_col=facet_col,
+                                    # facet_col_wrap=facet_col_wrap,
+                                    # category_orders=facet_order2,
+                                    # points='all',
+                                    # box=True,
+                                    # marginal_x=marginal_x,
+                                    # marginal_y=marginal_y,
+                                    # trendline=trendline,
+                                    # marginal=marginal,
+                                    # orientation=orientation,
+                                    symbol=symbol,
+                                    color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                    template=template)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -1078,6 +1551,12 @@ if rad == 'Visualization':
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color')
+
+        st.sidebar.markdown('Binning:')
+        bin_polar = st.sidebar.checkbox('Bin theta into sectors', key='bn_pl')
+        if bin_polar:
+            sectors = st.sidebar.number_input('Sectors:', min_value=4, max_value=72, value=SECTORS, step=4, key='se_pl')
+            polar_metric = st.sidebar.radio('r value:', ['count', 'sum of r'], key='pm_pl')
         # size = st.sidebar.selectbox('Size:', col_all, key='size')
         # symbol = st.sidebar.selectbox('Symbol:', col_all, key='symbol')
 
@@ -1100,42 +1579,65 @@ if rad == 'Visualization':
         #     facet_order2 = {facet_col: facet_order}
 
         st.sidebar.markdown('Define Labels and Theme:')
-        title = st.sidebar.text_input('Graph Title')
+        title = st.sidebar.text_input('Graph Title', key='t_pl')
         # xaxis_title = st.sidebar.text_input('x-axis title')
         # yaxis_title = st.sidebar.text_input('y-axis title')
         # legend_title = st.sidebar.selectbox('Legend Title:', col_all, key='lt')
         template = st.sidebar.selectbox('Choose theme:',
                                         ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white",
-                                         "none"])
+                                         "none"], key='te_pl')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['path11', 'y', 'color', 'bn_pl', 'se_pl', 'pm_pl', 't_pl', 'te_pl'])
         if st.sidebar.button('Click to generate graph'):
-            fig = px.line_polar(df1,r=x, theta=y,
-                            color=color,
-                            # size=size,
-                            # facet_col=facet_col,
-                            # facet_col_wrap=facet_col_wrap,
-                            # category_orders=facet_order2,
-                            # points='all',
-                            # box=True,
-                            # marginal_x=marginal_x,
-                            # marginal_y=marginal_y,
-                            # trendline=trendline,
-                            # marginal=marginal,
-                            # orientation=orientation,
-                            # symbol=symbol,
-                            line_close=True,
-                            color_discrete_sequence=px.colors.sequential.Plasma_r,
-                            template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if bin_polar:
+                    # One vertex per sector and color: the row count or sum of r
+                    if x is None or y is None:
+                        st.error('Binning needs an r (x-axis) and a theta (y-axis) column.')
+                        st.stop()
+                    if polar_metric == 'sum of r' and x not in profile.numeric:
+                        st.error('Summing needs a numeric r (x-axis) column.')
+                        st.stop()
+                    polar_data, _ = polar_bins(df1 if store is None else store, x, y, [color], sectors, None)
+                    polar_value = 'count' if polar_metric == 'count' else f'sum of {x}'
+                    if polar_value != 'count':
+                        polar_data = polar_data.rename(columns={'sum': polar_value})
+                    notes.caption(f'{len(polar_data):,} sector bins drawn.')
+                    fig = px.line_polar(polar_data, r=polar_value, theta=y,
+                                        color=color if color in polar_data else None,
+                                        line_close=True,
+                                        color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                        template=template)
+                else:
+                    fig = px.line_polar(df1,r=x, theta=y,
+                                    color=color,
+                                    # size=size,
+                                    # facet_col=facet_col,
+                                    # facet_col_wrap=facet_col_wrap,
+                                    # category_orders=facet_order2,
+                                    # points='all',
+                                    # box=True,
+                                    # marginal_x=marginal_x,
+                                    # marginal_y=marginal_y,
+                                    # trendline=trendline,
+                                    # marginal=marginal,
+                                    # orientation=orientation,
+                                    # symbol=symbol,
+                                    line_close=True,
+                                    color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                    template=template)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -1153,6 +1655,12 @@ if rad == 'Visualization':
         size = st.sidebar.selectbox('Size:', col_all, key='size_sg')
         # symbol = st.sidebar.selectbox('Symbol:', col_all, key='symbol')
         my_hover = st.sidebar.selectbox('Hover name:', col_all, key='h_sg')
+        rasterize_geo = st.sidebar.checkbox('Bin points on the server (for very large datasets)', key='rs_sg')
+        if rasterize_geo:
+            geo_shape = st.sidebar.selectbox('Grid:', GEO_SHAPES, key='gs_sg')
+            geo_scope = st.sidebar.selectbox('Map scope:', list(GEO_SCOPES), key='sc_sg')
+            geo_width = st.sidebar.number_input('Cells across the map:', min_value=10, max_value=720, value=GEO_CELLS, step=10, key='rw_sg')
+            geo_metric = st.sidebar.radio('Cell value:', ['count', 'sum of size'], key='gm_sg')
 
         # st.sidebar.markdown('Select Facet Dimension:')
         # facet_row = st.sidebar.selectbox('Facet Row:', col_all, key='fr')
@@ -1181,35 +1689,64 @@ if rad == 'Visualization':
                                         ["plotly", "plotly_white", "plotly_dark", "ggplot2", "seaborn", "simple_white",
                                          "none"], key='te_sg')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['long1', 'lat1', 'size_sg', 'h_sg', 'rs_sg', 'gs_sg', 'sc_sg', 'rw_sg', 'gm_sg',
+                                't_sg', 'te_sg'])
         if st.sidebar.button('Click to generate graph', key='b_sg'):
-            fig = px.scatter_geo(df1,lon=my_long, lat=my_lat,
-                            # color=color,
-                            size=size,
-                            # facet_col=facet_col,
-                            # facet_col_wrap=facet_col_wrap,
-                            # category_orders=facet_order2,
-                            # points='all',
-                            # box=True,
-                            # marginal_x=marginal_x,
-                            # marginal_y=marginal_y,
-                            # trendline=trendline,
-                            # marginal=marginal,
-                            # orientation=orientation,
-                            # symbol=symbol,
-                            # line_close=True,
-                            # color_discrete_sequence=px.colors.sequential.Plasma_r,
-                            hover_name=my_hover,
-                            template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if rasterize_geo:
+                    # Only the occupied cells of a square or hex grid over the map
+                    # scope are sent to the map, sized and coloured by their point
+                    # count (or summed size) and named by their most common label
+                    if my_long not in profile.numeric or my_lat not in profile.numeric:
+                        st.error('Binning needs numeric longitude and latitude columns.')
+                        st.stop()
+                    if geo_metric == 'sum of size' and size not in profile.numeric:
+                        st.error('Summing needs a numeric size column.')
+                        st.stop()
+                    geo_size = size if geo_metric == 'sum of size' else None
+                    cells = geo_bins(df1 if store is None else store, my_long, my_lat, geo_size, my_hover,
+                                     geo_shape, geo_width, geo_scope)
+                    geo_value = 'count' if geo_size is None else f'sum of {geo_size}'
+                    cells = cells.rename(columns={'sum': geo_value})
+                    notes.caption(f'{len(cells):,} occupied grid cells drawn.')
+                    fig = px.scatter_geo(cells, lon=my_long, lat=my_lat,
+                                         size=cells[geo_value].clip(lower=0),
+                                         color=geo_value,
+                                         hover_name=my_hover if my_hover in cells else None,
+                                         hover_data={'count': True},
+                                         scope=geo_scope,
+                                         template=template)
+                else:
+                    fig = px.scatter_geo(df1,lon=my_long, lat=my_lat,
+                                    # color=color,
+                                    size=size,
+                                    # facet_col=facet_col,
+                                    # facet_col_wrap=facet_col_wrap,
+                                    # category_orders=facet_order2,
+                                    # points='all',
+                                    # box=True,
+                                    # marginal_x=marginal_x,
+                                    # marginal_y=marginal_y,
+                                    # trendline=trendline,
+                                    # marginal=marginal,
+                                    # orientation=orientation,
+                                    # symbol=symbol,
+                                    # line_close=True,
+                                    # color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                    hover_name=my_hover,
+                                    template=template)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -1222,6 +1759,13 @@ if rad == 'Visualization':
 
         st.sidebar.markdown('Select Aesthetics:')
         color = st.sidebar.selectbox('Color:', col_all, key='color_pb')
+
+        st.sidebar.markdown('Binning:')
+        bin_polar = st.sidebar.checkbox('Draw a wind rose (bin theta into sectors and r into ranges)', key='bn_pb')
+        if bin_polar:
+            sectors = st.sidebar.number_input('Sectors:', min_value=4, max_value=72, value=SECTORS, step=4, key='se_pb')
+            ranges = st.sidebar.number_input('r ranges (colors when no color is chosen):', min_value=2, max_value=20, value=RANGES, key='ra_pb')
+            polar_metric = st.sidebar.radio('Wedge length:', ['count', 'sum of r'], key='pm_pb')
         # size = st.sidebar.selectbox('Size:', col_all, key='size')
         # symbol = st.sidebar.selectbox('Symbol:', col_all, key='symbol')
 
@@ -1253,34 +1797,61 @@ if rad == 'Visualization':
                                          "simple_white",
                                          "none"], key='te_bp')
 
+        chart_key = figure_key(df1 if store is None else store, rad,
+                               ['x_pb', 'y_pb', 'color_pb', 'bn_pb', 'se_pb', 'ra_pb', 'pm_pb', 't_pb', 'te_bp'])
         if st.sidebar.button('Click to generate graph', key='b_pb'):
-            fig = px.bar_polar(df1, r=x, theta=y,
-                               color=color,
-                               # size=size,
-                               # facet_col=facet_col,
-                               # facet_col_wrap=facet_col_wrap,
-                               # category_orders=facet_order2,
-                               # points='all',
-                               # box=True,
-                               # marginal_x=marginal_x,
-                               # marginal_y=marginal_y,
-                               # trendline=trendline,
-                               # marginal=marginal,
-                               # orientation=orientation,
-                               # symbol=symbol,
-                               # line_close=True,
-                               color_discrete_sequence=px.colors.sequential.Plasma_r,
-                               template=template)
-
-            fig.update_layout(
-                title=title)
-            # xaxis_title=xaxis_title,
-            # yaxis_title=yaxis_title,
-            # legend_title=legend_title)
-
-            st.plotly_chart(fig)
+            if not show_cached_figure(rad, chart_key):
+                notes = ChartNotes()
+                if bin_polar:
+                    # A wind rose: one stacked wedge per sector and r range (or
+                    # per sector and color), with the row count or sum of r
+                    if x is None or y is None:
+                        st.error('Binning needs an r (x-axis) and a theta (y-axis) column.')
+                        st.stop()
+                    if polar_metric == 'sum of r' and x not in profile.numeric:
+                        st.error('Summing needs a numeric r (x-axis) column.')
+                        st.stop()
+                    polar_data, polar_ranges = polar_bins(df1 if store is None else store, x, y, [color], sectors,
+                                                          ranges if color in (None, x, y) else None)
+                    polar_value = 'count' if polar_metric == 'count' else f'sum of {x}'
+                    if polar_value != 'count':
+                        polar_data = polar_data.rename(columns={'sum': polar_value})
+                    notes.caption(f'{len(polar_data):,} wedges drawn.')
+                    fig = px.bar_polar(polar_data, r=polar_value, theta=y,
+                                       color=color if color in polar_data else RANGE_COLUMN,
+                                       category_orders={RANGE_COLUMN: polar_ranges},
+                                       color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                       template=template)
+                    if y in profile.numeric:
+                        fig.update_traces(width=360 / sectors)
+                else:
+                    fig = px.bar_polar(df1, r=x, theta=y,
+                                       color=color,
+                                       # size=size,
+                                       # facet_col=facet_col,
+                                       # facet_col_wrap=facet_col_wrap,
+                                       # category_orders=facet_order2,
+                                       # points='all',
+                                       # box=True,
+                                       # marginal_x=marginal_x,
+                                       # marginal_y=marginal_y,
+                                       # trendline=trendline,
+                                       # marginal=marginal,
+                                       # orientation=orientation,
+                                       # symbol=symbol,
+                                       # line_close=True,
+                                       color_discrete_sequence=px.colors.sequential.Plasma_r,
+                                       template=template)
+
+                fig.update_layout(
+                    title=title)
+                # xaxis_title=xaxis_title,
+                # yaxis_title=yaxis_title,
+                # legend_title=legend_title)
+
+                show_figure(rad, chart_key, fig, notes)
         else:
-            pass
+            show_last_figure(rad)
 
 
 
@@ -0,0 +1,80 @@
+# Wind-rose binning for the polar charts
+#
+# px.bar_polar draws one wedge per row, and the line and scatter variants
+# one vertex or marker per row. Here theta is binned into equal sectors (or
+# kept as is when it is categorical) and r into ranges, and the rows of each
+# sector / range / color group are reduced to a count and a sum of r, so the
+# figure grows with the number of sectors and not with the number of rows.
+import numpy as np
+import pandas as pd
+
+from aggregate import group_columns
+from binning import bin_edges
+from cache import dataset_cache, dataset_key
+from raster import source_chunks, value_range
+
+SECTORS = 16
+RANGES = 5
+RANGE_COLUMN = 'range'
+
+
+def range_labels(edges):
+    return [f'{a:.4g} to {b:.4g}' for a, b in zip(edges[:-1], edges[1:])]
+
+
+def _sectors(values, sectors):
+    # Sector centres for numeric angles in degrees, categories otherwise
+    if not pd.api.types.is_numeric_dtype(values):
+        return values.astype(str).to_numpy()
+    width = 360 / sectors
+    degrees = np.mod(values.to_numpy(dtype=float, na_value=np.nan), 360)
+    return (np.floor(degrees / width) + 0.5) * width
+
+
+def polar_bins(source, r, theta, by=(), sectors=SECTORS, ranges=RANGES):
+    # Count and sum of r per theta sector, r range and by group (the color
+    # and symbol columns) for a frame or SQLStore. ranges=None leaves r
+    # unbinned, with one row per sector and group.
+    # A numeric r is cut into ranges equal-width ranges labelled by
+    # range_labels, a categorical r keeps its categories as the ranges.
+    # Returns the frame (theta holding the sector, RANGE_COLUMN the range)
+    # and the range labels in order.
+    by = group_columns(by, r, theta)
+    numeric_r = pd.api.types.is_numeric_dtype(source[r] if isinstance(source, pd.DataFrame) else source.dtypes[r])
+    edges = None
+    if ranges and numeric_r:
+        lo, hi = value_range(source, r)
+        edges = bin_edges(float(lo), float(hi), ranges)
+    key = ('polar-bins', dataset_key(source) if isinstance(source, pd.DataFrame) else source.path,
+           r, theta, tuple(by), sectors, ranges)
+
+    def compute():
+        cols = list(dict.fromkeys([r, theta] + by))
+        labels = np.array(range_labels(edges), dtype=object) if edges is not None else None
+        keys = [theta] + ([RANGE_COLUMN] if ranges else []) + by
+        parts = []
+        for chunk in source_chunks(source, cols):
+            part = pd.DataFrame({theta: _sectors(chunk[theta], sectors), 'count': 1.0})
+            if numeric_r:
+                rs = chunk[r].to_numpy(dtype=float, na_value=np.nan)
+                part['sum'] = rs
+                if edges is not None:
+                    part[RANGE_COLUMN] = labels[np.clip(np.searchsorted(edges, rs, side='right') - 1, 0, len(labels) - 1)]
+                    part.loc[np.isnan(rs), RANGE_COLUMN] = None
+            elif ranges:
+                part[RANGE_COLUMN] = chunk[r].astype(str).to_numpy()
+            for col in by:
+                part[col] = chunk[col].to_numpy()
+            parts.append(part.groupby(keys, sort=False).sum().reset_index())
+        if not parts:
+            return pd.DataFrame(columns=keys + ['count']), []
+        binned = pd.concat(parts, ignore_index=True).groupby(keys).sum().reset_index()
+        if labels is not None:
+            order = list(labels)
+        elif ranges:
+            order = sorted(binned[RANGE_COLUMN].unique())
+        else:
+            order = []
+        return binned, order
+
+    return dataset_cache.get_or_compute(key, compute)
@@ -0,0 +1,151 @@
+# Paginated data preview
+#
+# Only the rows on the current page are sent to the browser. Sorting and
+# filtering run on the server against the cached frame, and the resulting
+# row order is cached so that paging through it is a cheap slice.
+#
+# Filters are parsed here rather than handed to DataFrame.eval, which would
+# run any Python expression typed into the box. Only comparisons of a column
+# with a literal, combined with and / or / not and parentheses, are accepted.
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+from cache import dataset_cache, dataset_key
+
+
+COMPARISONS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt,
+               '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<quoted>`[^`]+`)
+  | (?P<op>==|!=|<=|>=|<|>|\(|\))
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+)""", re.VERBOSE)
+
+
+def _tokens(query):
+    tokens, pos = [], 0
+    query = query.strip()
+    while pos < len(query):
+        match = _TOKEN.match(query, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f'unexpected text at "{query[pos:pos + 20]}"')
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'name' and text.lower() in ('and', 'or', 'not'):
+            kind, text = 'op', text.lower()
+        tokens.append((kind, text))
+        pos = match.end()
+    return tokens
+
+
+class _Filter:
+    # Recursive descent over the tokens, building the boolean row mask:
+    #   expr := term ('or' term)*    term := factor ('and' factor)*
+    #   factor := 'not' factor | '(' expr ')' | column op literal
+
+    def __init__(self, df, tokens):
+        self.df = df
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, text=None):
+        kind, value = self.peek()
+        if kind is None or (text is not None and value != text):
+            raise ValueError(f'expected {text or "more input"} at the end of the filter'
+                             if kind is None else f'expected {text} before "{value}"')
+        self.pos += 1
+        return kind, value
+
+    def parse(self):
+        mask = self.expr()
+        if self.pos < len(self.tokens):
+            raise ValueError(f'unexpected "{self.tokens[self.pos][1]}"')
+        return mask
+
+    def expr(self):
+        mask = self.term()
+        while self.peek() == ('op', 'or'):
+            self.take()
+            mask = mask | self.term()
+        return mask
+
+    def term(self):
+        mask = self.factor()
+        while self.peek() == ('op', 'and'):
+            self.take()
+            mask = mask & self.factor()
+        return mask
+
+    def factor(self):
+        if self.peek() == ('op', 'not'):
+            self.take()
+            return ~self.factor()
+        if self.peek() == ('op', '('):
+            self.take()
+            mask = self.expr()
+            self.take(')')
+            return mask
+        return self.comparison()
+
+    def comparison(self):
+        kind, column = self.take()
+        if kind == 'quoted':
+            column = column[1:-1]
+        elif kind != 'name':
+            raise ValueError(f'expected a column name before "{column}"')
+        if column not in self.df.columns:
+            raise ValueError(f'unknown column "{column}"')
+        kind, op = self.take()
+        if op not in COMPARISONS:
+            raise ValueError(f'expected a comparison after "{column}"')
+        return COMPARISONS[op](self.df[column], self.literal()).to_numpy(dtype=bool, na_value=False)
+
+    def literal(self):
+        kind, text = self.take()
+        if kind == 'number':
+            return float(text) if any(c in text for c in '.eE') else int(text)
+        if kind == 'string':
+            return re.sub(r'\\(.)', r'\1', text[1:-1])
+        if kind == 'name' and text in ('True', 'False'):
+            return text == 'True'
+        raise ValueError(f'expected a number, a quoted string, True or False instead of "{text}"')
+
+
+def filter_mask(df, query):
+    # Boolean mask of the rows matching a filter such as
+    # salary > 30000 and (gender == "Male" or `job title` != "OFW")
+    return _Filter(df, _tokens(query)).parse()
+
+
+def row_order(df, query='', sort_by=None, ascending=True):
+    # Positions of the rows matching query, in display order
+    key = ('preview', dataset_key(df), query, sort_by, ascending)
+
+    def compute():
+        positions = np.arange(len(df), dtype=np.int64)
+        if query:
+            positions = positions[filter_mask(df, query)]
+        if sort_by is not None:
+            # Categories sort by value rather than by category order
+            values = pd.Series(np.asarray(df[sort_by].iloc[positions]))
+            try:
+                order = values.sort_values(ascending=ascending, kind='mergesort', na_position='last').index
+            except TypeError:
+                order = values.astype(str).sort_values(ascending=ascending, kind='mergesort').index
+            positions = positions[order.to_numpy()]
+        return positions
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+def page(df, positions, page_number, page_size):
+    start = (page_number - 1) * page_size
+    return df.iloc[positions[start:start + page_size]]
@@ -0,0 +1,82 @@
+# Server-side rasterization for the Scatter chart
+#
+# Past a few million points even WebGL gives up. Instead of sending every
+# point, the points are binned into a fixed pixel grid here and only the grid
+# goes to the browser, so the payload depends on the image size and not on
+# the number of rows.
+import numpy as np
+import pandas as pd
+
+from aggregate import group_columns
+from cache import dataset_cache, dataset_key
+
+AGGREGATES = ['count', 'mean', 'max']
+CHUNK_ROWS = 1_000_000
+
+
+def value_range(source, col):
+    if isinstance(source, pd.DataFrame):
+        values = source[col]
+        return values.min(), values.max()
+    return source.min_max(col)
+
+
+def source_chunks(source, cols):
+    # In-memory frames are sliced to bound the temporaries; an out-of-core
+    # store streams its table from disk
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), CHUNK_ROWS):
+            yield source[cols].iloc[start:start + CHUNK_ROWS]
+    else:
+        for chunk in source.iter_chunks(CHUNK_ROWS // 5):
+            yield chunk[cols]
+
+
+def _source_key(source):
+    return dataset_key(source) if isinstance(source, pd.DataFrame) else source.path
+
+
+def rasterize(source, x, y, value=None, agg='count', width=600, height=400, x_range=None, y_range=None):
+    # Bin the x/y points of a frame or SQLStore into a height x width grid and
+    # reduce each pixel to the point count, or the mean or max of value.
+    # Returns the image (NaN where a pixel is empty) and the pixel centres.
+    value = None if agg == 'count' else value
+    x_range = tuple(float(v) for v in (x_range or value_range(source, x)))
+    y_range = tuple(float(v) for v in (y_range or value_range(source, y)))
+    key = ('raster', _source_key(source), x, y, value, agg, width, height, x_range, y_range)
+
+    def compute():
+        size = width * height
+        counts = np.zeros(size)
+        totals = np.zeros(size) if agg == 'mean' else None
+        peaks = np.full(size, -np.inf) if agg == 'max' else None
+        (x0, x1), (y0, y1) = x_range, y_range
+        cols = group_columns([x, y, value])
+        for chunk in source_chunks(source, cols):
+            xs = chunk[x].to_numpy(dtype=float, na_value=np.nan)
+            ys = chunk[y].to_numpy(dtype=float, na_value=np.nan)
+            keep = (xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)
+            if value is not None:
+                vs = chunk[value].to_numpy(dtype=float, na_value=np.nan)
+                keep &= ~np.isnan(vs)
+                vs = vs[keep]
+            ix = np.minimum(((xs[keep] - x0) / ((x1 - x0) or 1) * width).astype(np.int64), width - 1)
+            iy = np.minimum(((ys[keep] - y0) / ((y1 - y0) or 1) * height).astype(np.int64), height - 1)
+            pixel = iy * width + ix
+            counts += np.bincount(pixel, minlength=size)
+            if totals is not None:
+                totals += np.bincount(pixel, weights=vs, minlength=size)
+            if peaks is not None:
+                np.maximum.at(peaks, pixel, vs)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if agg == 'mean':
+                image = totals / counts
+            elif agg == 'max':
+                image = np.where(counts > 0, peaks, np.nan)
+            else:
+                image = np.where(counts > 0, counts, np.nan)
+        xs = x0 + (np.arange(width) + 0.5) * (x1 - x0) / width
+        ys = y0 + (np.arange(height) + 0.5) * (y1 - y0) / height
+        return image.reshape(height, width), xs, ys
+
+    return dataset_cache.get_or_compute(key, compute)
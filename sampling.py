@@ -0,0 +1,107 @@
+# Row sampling for charts that draw one mark per row
+#
+# Strip, Scatter Matrix and Polar Scatter cannot be pre-aggregated without
+# changing what they show, so large datasets are drawn from a sample
+# instead. Samples are stratified by the chart's color / facet columns so
+# that rare categories keep some rows, use a fixed seed so every rerun draws
+# the same rows, and are cached per dataset, strata and size. Only columns
+# with few distinct values are used as strata: a numeric or ID-like color
+# would give every row its own stratum and the sample would be the table.
+import numpy as np
+import pandas as pd
+
+from aggregate import group_columns
+from cache import dataset_cache, dataset_key
+
+SAMPLE_SIZE = 20_000
+SAMPLE_SEED = 1
+MIN_PER_STRATUM = 50
+MAX_STRATUM_VALUES = 50
+CHUNK_ROWS = 200_000
+
+
+def allocate(counts, n, floor=MIN_PER_STRATUM):
+    # Rows to draw from each stratum, at most n in total: every stratum gets
+    # a floor (or the whole stratum if smaller), lowered so that the floors
+    # alone fit in n, and the rest of n is shared in proportion to the rows
+    # each stratum has left
+    counts = counts[counts > 0]
+    if counts.sum() <= n:
+        return counts
+    floors = np.minimum(counts, min(floor, n // len(counts)))
+    rest = counts - floors
+    extra = np.floor(rest * ((n - floors.sum()) / rest.sum()))
+    return (floors + extra).astype(np.int64)
+
+
+def reservoir_sample(chunks, n, by=(), quotas=None, seed=SAMPLE_SEED):
+    # One pass over a stream of frames. Every row gets a random key and each
+    # stratum keeps the rows with the smallest keys, which is a uniform
+    # sample without replacement of the rows seen so far. quotas (a Series
+    # indexed like a groupby on by) sets the size per stratum; without it a
+    # single reservoir of n rows is kept.
+    by = group_columns(by)
+    rng = np.random.default_rng(seed)
+    kept = None
+    seen = 0
+    for chunk in chunks:
+        chunk = chunk.assign(_key=rng.random(len(chunk)), _row=np.arange(seen, seen + len(chunk)))
+        seen += len(chunk)
+        kept = chunk if kept is None else pd.concat([kept, chunk], ignore_index=True)
+        kept = kept.sort_values('_key', kind='stable')
+        if not by:
+            kept = kept.iloc[:n]
+            continue
+        rank = kept.groupby(by, observed=True, dropna=False).cumcount().to_numpy()
+        limit = quotas.reindex(pd.MultiIndex.from_frame(kept[by]) if len(by) > 1 else kept[by[0]]).fillna(0).to_numpy()
+        kept = kept.loc[rank < limit]
+    if kept is None:
+        return pd.DataFrame()
+    # Back to stream order
+    return kept.sort_values('_row').drop(columns=['_key', '_row']).reset_index(drop=True)
+
+
+def sample_caption(sample, rows, by=()):
+    by = group_columns(by)
+    text = f'Drawn from a sample of {len(sample):,} of {rows:,} rows ({len(sample) / max(rows, 1):.1%})'
+    return text + (f', stratified by {", ".join(map(str, by))}.' if by else '.')
+
+
+def sample_strata(source, by=()):
+    # The by columns with at most MAX_STRATUM_VALUES distinct values
+    def distinct(col):
+        if isinstance(source, pd.DataFrame):
+            return source[col].nunique()
+        return source.top_categories(col, n=1)[1]
+
+    return [c for c in group_columns(by) if distinct(c) <= MAX_STRATUM_VALUES]
+
+
+def stratified_sample(source, n=SAMPLE_SIZE, by=(), seed=SAMPLE_SEED):
+    # At most n rows of a DataFrame or out-of-core store, stratified by the
+    # sample_strata of the by columns. Returns the sample and the number of
+    # rows it was drawn from.
+    by = sample_strata(source, by)
+    in_memory = isinstance(source, pd.DataFrame)
+    rows = len(source) if in_memory else source.rows
+    key = ('stratified-sample', dataset_key(source) if in_memory else source.path, tuple(by), n, seed)
+
+    def compute():
+        if rows <= n:
+            return (source if in_memory else source.sample(rows)), rows
+        if in_memory:
+            rng = np.random.default_rng(seed)
+            if not by:
+                return source.iloc[np.sort(rng.choice(rows, n, replace=False))], rows
+            groups = source.groupby([source[c] for c in by], observed=True).indices
+            quotas = allocate(pd.Series({k: len(v) for k, v in groups.items()}, dtype=np.int64), n)
+            keep = [rng.choice(groups[k], q, replace=False) for k, q in quotas.items()]
+            return source.iloc[np.sort(np.concatenate(keep))], rows
+        if not by:
+            return source.sample(n, seed), rows
+        # Out-of-core: the stratum sizes come from SQLite and the table is
+        # streamed once through the reservoirs
+        sizes = source.group_agg(by).set_index(by).iloc[:, -1]
+        return reservoir_sample(source.iter_chunks(CHUNK_ROWS), n, by, allocate(sizes, n), seed), rows
+
+    return dataset_cache.get_or_compute(key, compute)
@@ -0,0 +1,303 @@
+# Out-of-core mode
+#
+# The dataset is streamed chunk by chunk into a local SQLite file and never
+# held in memory as a whole. Charts ask the store for the aggregates they
+# need (group-by sums, bin counts, min/max) and only those small results come
+# back as pandas frames.
+import contextlib
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from aggregate import OTHER, TOP_N, group_columns
+from cache import dataset_cache
+from loader import fingerprint, iter_chunks, peek_dataset, source_name, source_labels, source_column
+
+TABLE = 'data'
+SAMPLE_ROWS = 100_000
+AGGREGATES = {'sum': 'SUM', 'mean': 'AVG', 'count': 'COUNT', 'min': 'MIN', 'max': 'MAX'}
+STORE_BUDGET = int(float(os.environ.get('PEDAL_STORE_MB', 20480)) * 1024 ** 2)
+
+
+def store_dir():
+    path = os.environ.get('PEDAL_STORE_DIR') or os.path.join(tempfile.gettempdir(), 'pedal_store')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _sql_value(v):
+    # sqlite3 only binds plain Python scalars
+    return v.item() if isinstance(v, np.generic) else v
+
+
+class SQLStore:
+    """A dataset kept on disk in SQLite, queried for chart aggregates."""
+
+    def __init__(self, path, dtypes, rows):
+        self.path = path
+        self.dtypes = dtypes
+        self.rows = rows
+
+    @property
+    def columns(self):
+        return list(self.dtypes.index)
+
+    def numeric_columns(self):
+        return [c for c, t in self.dtypes.items() if pd.api.types.is_numeric_dtype(t)]
+
+    def connect(self):
+        return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+
+    def query(self, sql, params=()):
+        # Results are small, so they are cached next to the datasets
+        key = ('sql', self.path, sql, tuple(params))
+
+        def run():
+            with contextlib.closing(self.connect()) as conn:
+                return pd.read_sql_query(sql, conn, params=[_sql_value(p) for p in params])
+
+        return dataset_cache.get_or_compute(key, run)
+
+    def iter_chunks(self, chunksize):
+        # The whole table, one frame of chunksize rows at a time
+        with contextlib.closing(self.connect()) as conn:
+            yield from pd.read_sql_query(f'SELECT * FROM {TABLE}', conn, chunksize=chunksize)
+
+    def head(self, n=1000):
+        return self.query(f'SELECT * FROM {TABLE} LIMIT ?', (n,))
+
+    def sample(self, n, seed=1):
+        # Rows are only ever appended, so rowids are exactly 1..rows and a
+        # uniform sample can be drawn without scanning the table
+        if n >= self.rows:
+            return self.query(f'SELECT * FROM {TABLE}')
+        key = ('sql-sample', self.path, n, seed)
+
+        def run():
+            ids = np.sort(np.random.default_rng(seed).choice(self.rows, size=n, replace=False) + 1)
+            with contextlib.closing(self.connect()) as conn:
+                conn.execute('CREATE TEMP TABLE pick (id INTEGER PRIMARY KEY)')
+                conn.executemany('INSERT INTO pick VALUES (?)', ((int(i),) for i in ids))
+                return pd.read_sql_query(f'SELECT {TABLE}.* FROM {TABLE} JOIN pick ON {TABLE}.rowid = pick.id', conn)
+
+        return dataset_cache.get_or_compute(key, run)
+
+    def min_max(self, col):
+        df = self.query(f'SELECT MIN({quote(col)}) AS lo, MAX({quote(col)}) AS hi FROM {TABLE}')
+        return df['lo'].iloc[0], df['hi'].iloc[0]
+
+    def describe(self, cols):
+        # Count, mean, std, min and max per numeric column in two table scans:
+        # the variance is summed around the means of the first scan, as
+        # AVG(x * x) - AVG(x) ** 2 cancels for offset data such as timestamps
+        exprs = []
+        for i, c in enumerate(cols):
+            q = quote(c)
+            exprs += [f'COUNT({q}) AS c{i}', f'AVG({q}) AS m{i}', f'MIN({q}) AS lo{i}', f'MAX({q}) AS hi{i}']
+        if not exprs:
+            return pd.DataFrame()
+        r = self.query(f'SELECT {", ".join(exprs)} FROM {TABLE}').iloc[0]
+        means = [0.0 if pd.isna(r[f'm{i}']) else float(r[f'm{i}']) for i in range(len(cols))]
+        squares = ', '.join(f'SUM(({quote(c)} - ?) * ({quote(c)} - ?)) AS s{i}' for i, c in enumerate(cols))
+        s = self.query(f'SELECT {squares} FROM {TABLE}', [m for m in means for _ in range(2)]).iloc[0]
+        out = {}
+        for i, c in enumerate(cols):
+            n = r[f'c{i}']
+            std = np.sqrt(s[f's{i}'] / (n - 1)) if n > 1 else np.nan
+            out[c] = {'count': n, 'mean': r[f'm{i}'], 'std': std, 'min': r[f'lo{i}'], 'max': r[f'hi{i}']}
+        return pd.DataFrame(out)
+
+    def top_categories(self, col, value=None, agg='sum', n=TOP_N):
+        # Same as aggregate.top_categories
+        measure = f'SUM({quote(value)})' if value is not None and agg == 'sum' else 'COUNT(*)'
+        top = self.query(f'SELECT {quote(col)} AS value FROM {TABLE} WHERE {quote(col)} IS NOT NULL '
+                         f'GROUP BY {quote(col)} ORDER BY {measure} DESC LIMIT ?', (n,))
+        total = self.query(f'SELECT COUNT(DISTINCT {quote(col)}) AS n FROM {TABLE}')['n'].iloc[0]
+        return tuple(top['value']), int(total)
+
+    def group_agg(self, by, value=None, agg='sum', weighted_mean=(), keep=None):
+        # Same result as aggregate.group_agg: one row per group with AGG(value)
+        # (or the row count) last, after any value-weighted means
+        by = group_columns(by)
+        weighted_mean = group_columns(weighted_mean, *by)
+        keep = {c: v for c, v in (keep or {}).items() if c in by}
+        counting = value is None or agg == 'count'
+        name = 'count' if counting else value
+        if name in by or name in weighted_mean:
+            name = f'{agg} of {name}'
+        measure = 'COUNT(*)' if counting else f'{AGGREGATES[agg]}({quote(value)})'
+        weight = quote(value) if value is not None else '1.0'
+        params = []
+        keys = []
+        for c in by:
+            if c in keep:
+                # Values outside keep are grouped as OTHER
+                marks = ', '.join('?' * len(keep[c]))
+                keys.append(f'CASE WHEN {quote(c)} IS NULL OR {quote(c)} IN ({marks}) THEN {quote(c)} ELSE ? END')
+                params += [*keep[c], OTHER]
+            else:
+                keys.append(quote(c))
+        select = [f'{k} AS {quote(c)}' for k, c in zip(keys, by)]
+        # * 1.0 keeps SQLite from dividing integer columns as integers
+        select += [f'SUM({quote(c)} * {weight}) * 1.0 / SUM({weight}) AS {quote(c)}' for c in weighted_mean]
+        select.append(f'{measure} AS {quote(name)}')
+        if not by:
+            return self.query(f'SELECT {", ".join(select)} FROM {TABLE}')
+        # Group on the select list positions so folded keys are grouped as folded
+        cols = ', '.join(str(i + 1) for i in range(len(by)))
+        return self.query(f'SELECT {", ".join(select)} FROM {TABLE} GROUP BY {cols}', params)
+
+    def histogram(self, x, nbins, y=None, by=(), agg='sum'):
+        # Equal-width bins over [min, max] of x, per group. Returns the binned
+        # frame (bin centre in column x) and the bin edges.
+        lo, hi = self.min_max(x)
+        if pd.isna(lo):
+            # Nothing to bin (no rows, or no values of x): the query below
+            # returns an empty frame with the usual columns
+            lo, hi = 0.0, 1.0
+        edges = np.linspace(lo, hi if hi > lo else lo + 1, nbins + 1)
+        width = edges[1] - edges[0]
+        by = group_columns(by, x)
+        measure = 'COUNT(*)' if y is None else f'{AGGREGATES[agg]}({quote(y)})'
+        bin_expr = f'MIN(CAST(({quote(x)} - ?) / ? AS INTEGER), {nbins - 1})'
+        group = ', '.join([quote(c) for c in by] + ['bin'])
+        select = ', '.join([quote(c) for c in by] + [f'{bin_expr} AS bin', f'{measure} AS {quote(y or "count")}'])
+        # query() returns the cached frame, so the centres go on a copy
+        df = self.query(f'SELECT {select} FROM {TABLE} WHERE {quote(x)} IS NOT NULL GROUP BY {group}',
+                        (float(lo), float(width))).copy()
+        df[x] = edges[0] + (df.pop('bin') + 0.5) * width
+        return df, edges
+
+    def histogram2d(self, x, y, nbinsx, nbinsy, by=()):
+        # Counts on an nbinsx x nbinsy grid, per group. Returns the binned frame
+        # (bin centres in columns x and y) and the x and y bin edges.
+        by = group_columns(by, x, y)
+        params, exprs, centres = [], [], {}
+        for col, n, alias in [(x, nbinsx, 'bx'), (y, nbinsy, 'by')]:
+            lo, hi = self.min_max(col)
+            if pd.isna(lo):
+                lo, hi = 0.0, 1.0
+            edges = np.linspace(lo, hi if hi > lo else lo + 1, n + 1)
+            params += [float(lo), float(edges[1] - edges[0])]
+            exprs.append(f'MIN(CAST(({quote(col)} - ?) / ? AS INTEGER), {n - 1}) AS {alias}')
+            centres[alias] = (col, edges)
+        group = ', '.join([quote(c) for c in by] + ['bx', 'by'])
+        select = ', '.join([quote(c) for c in by] + exprs + ['COUNT(*) AS count'])
+        df = self.query(f'SELECT {select} FROM {TABLE} WHERE {quote(x)} IS NOT NULL AND {quote(y)} IS NOT NULL '
+                        f'GROUP BY {group}', params).copy()
+        for alias, (col, edges) in centres.items():
+            df[col] = (edges[:-1] + np.diff(edges) / 2)[df.pop(alias).to_numpy(dtype=np.int64)]
+        return df, centres['bx'][1], centres['by'][1]
+
+
+def _build(sources, usecols, path):
+    # Each build writes its own temporary file, so builds of the same store
+    # in several sessions cannot clobber each other
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    os.close(fd)
+    dtypes = None
+    rows = 0
+    labels = source_labels([source_name(s) for s in sources])
+    label_column = None
+    if len(sources) > 1:
+        # As in loader.concat_frames: NaN rows are dropped, so only the
+        # columns every file has are stored
+        common = set.intersection(*(set(peek_dataset(s).columns) for s in sources))
+        usecols = [c for c in (usecols or peek_dataset(sources[0]).columns) if c in common]
+    try:
+        with contextlib.closing(sqlite3.connect(tmp_path)) as conn:
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            for source, label in zip(sources, labels):
+                for chunk in iter_chunks(source, usecols=usecols):
+                    if len(sources) > 1:
+                        label_column = label_column or source_column(chunk.columns)
+                        chunk = chunk.assign(**{label_column: label})
+                    if dtypes is None:
+                        dtypes = chunk.dtypes
+                    chunk.to_sql(TABLE, conn, if_exists='append', index=False, chunksize=10_000)
+                    rows += len(chunk)
+            if dtypes is None:
+                # No rows at all: an empty table with the header's columns, so
+                # that queries return empty frames instead of failing
+                head = peek_dataset(sources[0])
+                head = head[[c for c in head.columns if usecols is None or c in usecols]].iloc[:0]
+                if len(sources) > 1:
+                    head = head.assign(**{label_column or source_column(head.columns): pd.Series(dtype=object)})
+                head.to_sql(TABLE, conn, index=False)
+                dtypes = head.dtypes
+            conn.commit()
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    # Only a complete store is ever visible under its final name
+    os.replace(tmp_path, path)
+    return dtypes, rows
+
+
+def _evict(keep):
+    # Remove the least recently used stores (and leftover temporary files)
+    # until the store folder fits in STORE_BUDGET; keep is never removed
+    folder = os.path.dirname(keep)
+    files = []
+    for name in os.listdir(folder):
+        if name.endswith(('.sqlite', '.part')):
+            try:
+                st = os.stat(os.path.join(folder, name))
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, os.path.join(folder, name)))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= STORE_BUDGET:
+            break
+        if path == keep or (path.endswith('.part') and time.time() - os.path.getmtime(path) < 24 * 3600):
+            # In use, or a build that may still be running
+            continue
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+
+
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def build_store(sources, usecols=None):
+    # Stream one or more dataset files into SQLite. The store is reused for as
+    # long as the file exists, across reruns, sessions and server restarts.
+    digest = hashlib.blake2b(repr((sorted(fingerprint(s) for s in sources),
+                                   sorted(usecols or [], key=str))).encode(), digest_size=16).hexdigest()
+    path = os.path.join(store_dir(), f'{digest}.sqlite')
+
+    def build():
+        # One build per store at a time; a second session waits for it
+        with _build_locks_lock:
+            lock = _build_locks.setdefault(path, threading.Lock())
+        with lock:
+            if os.path.exists(path):
+                # Marks the store as recently used for _evict
+                os.utime(path)
+                with contextlib.closing(sqlite3.connect(f'file:{path}?mode=ro', uri=True)) as conn:
+                    head = pd.read_sql_query(f'SELECT * FROM {TABLE} LIMIT 1000', conn)
+                    rows = conn.execute(f'SELECT MAX(rowid) FROM {TABLE}').fetchone()[0] or 0
+                return SQLStore(path, head.infer_objects().dtypes, rows)
+            dtypes, rows = _build(sources, usecols, path)
+            _evict(path)
+            return SQLStore(path, dtypes, rows)
+
+    store = dataset_cache.get_or_compute(('sql-store', path), build)
+    if not os.path.exists(store.path):
+        # Evicted from disk while still cached in memory
+        store = dataset_cache.put(('sql-store', path), build())
+    return store
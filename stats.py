@@ -0,0 +1,292 @@
+# Column statistics for the Descriptive Statistics panel and sidebar widgets
+import numpy as np
+import pandas as pd
+
+from cache import dataset_cache, dataset_key, object_size
+
+UNIQUE_MAX = 1000
+
+
+class ColumnProfile:
+    """Per-column summary of a dataset, computed once when it is first shown."""
+
+    def __init__(self, df):
+        self.columns = list(df.columns)
+        self.rows = len(df)
+        self.nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        self.numeric = list(df.select_dtypes(include='number').columns)
+        self.describe = df[self.numeric].describe() if self.numeric else pd.DataFrame()
+
+        rows = {}
+        self.uniques = {}
+        for col in self.columns:
+            s = df[col]
+            values = s.dropna().unique()
+            self.uniques[col] = list(values[:UNIQUE_MAX])
+            orderable = col in self.numeric or pd.api.types.is_datetime64_any_dtype(s)
+            rows[col] = {'dtype': str(s.dtype),
+                         'nulls': int(s.isna().sum()),
+                         'unique': len(values),
+                         'min': s.min() if orderable and len(values) else np.nan,
+                         'max': s.max() if orderable and len(values) else np.nan}
+        self.table = pd.DataFrame.from_dict(rows, orient='index')
+
+    def __sizeof__(self):
+        return object_size(self.table) + object_size(self.describe) + object_size(self.uniques)
+
+    def unique_values(self, col):
+        # Distinct values of a column, capped at UNIQUE_MAX for high-cardinality columns
+        return self.uniques[col]
+
+    def cardinality(self, col):
+        return int(self.table.loc[col, 'unique'])
+
+
+def column_profile(df):
+    return dataset_cache.get_or_compute(('profile', dataset_key(df)), lambda: ColumnProfile(df))
+
+
+CORRELATION_METHODS = ['pearson', 'spearman']
+
+
+def _correlate(x):
+    # Pearson correlation between the columns of a float matrix, each pair
+    # over the rows where both are present, from a handful of matrix products.
+    # The columns are centred first: raw moments of offset data such as epoch
+    # timestamps cancel catastrophically in the subtractions below, while
+    # the means of a centred pair over its shared rows stay close to zero.
+    present = (~np.isnan(x)).astype(float)
+    x = np.nan_to_num(x - np.nansum(x, axis=0) / np.maximum(present.sum(axis=0), 1))
+    n = present.T @ present
+    sums = x.T @ present
+    squares = (x * x).T @ present
+    products = x.T @ x
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = products / n - (sums / n) * (sums.T / n)
+        var = squares / n - (sums / n) ** 2
+        return np.clip(cov / np.sqrt(var * var.T), -1, 1)
+
+
+def correlation_ranking(df, cols, method='pearson'):
+    # Correlation matrix of the numeric columns cols (Spearman is Pearson on
+    # the ranks) and every pair of columns ranked by the strength of their
+    # correlation
+    key = ('correlation', dataset_key(df), tuple(cols), method)
+
+    def compute():
+        data = df[list(cols)]
+        if method == 'spearman':
+            data = data.rank()
+        matrix = pd.DataFrame(_correlate(data.to_numpy(dtype=float, na_value=np.nan)), index=cols, columns=cols)
+        i, j = np.triu_indices(len(cols), k=1)
+        pairs = pd.DataFrame({'column 1': np.asarray(cols, dtype=object)[i], 'column 2': np.asarray(cols, dtype=object)[j],
+                              method: matrix.to_numpy()[i, j]})
+        pairs = pairs.iloc[np.argsort(-np.abs(pairs[method].to_numpy()), kind='stable')].reset_index(drop=True)
+        return matrix, pairs
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+# Approximate statistics
+#
+# A single pass over the data in chunks. Every summary below can be merged
+# with another one of the same kind, so chunks can come from a csv reader, a
+# list of partitions or the out-of-core store and be combined in any order.
+
+TDIGEST_DELTA = 200
+HLL_P = 14
+CHUNK_ROWS = 200_000
+
+
+class TDigest:
+    """Mergeable quantile sketch (t-digest with the arcsine scale function)."""
+
+    def __init__(self, delta=TDIGEST_DELTA):
+        self.delta = delta
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        # Centroids are small near the tails and large around the median
+        k = np.floor(self.delta / (2 * np.pi) * np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.r_[True, k[1:] != k[:-1]])
+        w = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / w
+        self.weights = w
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return self
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._compress(np.r_[self.means, values], np.r_[self.weights, np.ones(len(values))])
+        return self
+
+    def merge(self, other):
+        if len(other.weights):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._compress(np.r_[self.means, other.means], np.r_[self.weights, other.weights])
+        return self
+
+    def quantile(self, q):
+        if not len(self.weights):
+            return np.nan
+        mids = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(q * self.count, np.r_[0, mids, self.count], np.r_[self.min, self.means, self.max]))
+
+    def rank_error(self, q):
+        # Half the weight of the centroid holding quantile q, as a fraction of
+        # all values: the estimate is off by at most about this many ranks
+        if not len(self.weights):
+            return np.nan
+        i = min(np.searchsorted(np.cumsum(self.weights), q * self.count), len(self.weights) - 1)
+        return float(self.weights[i] / 2 / self.count)
+
+
+def _leading_zeros(x):
+    n = np.zeros(len(x), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_clear = x < (np.uint64(1) << np.uint64(64 - shift))
+        n[top_clear] += shift
+        x = np.where(top_clear, x << np.uint64(shift), x)
+    return n
+
+
+class HyperLogLog:
+    """Mergeable distinct-count sketch with 2**p registers."""
+
+    def __init__(self, p=HLL_P):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def update(self, series):
+        series = series.dropna()
+        if not len(series):
+            return self
+        h = pd.util.hash_pandas_object(series, index=False).to_numpy(dtype=np.uint64)
+        idx = (h >> np.uint64(64 - self.p)).astype(np.int64)
+        # A guard bit below the index bits bounds the rank at 64 - p + 1
+        rest = (h << np.uint64(self.p)) | (np.uint64(1) << np.uint64(self.p - 1))
+        np.maximum.at(self.registers, idx, (_leading_zeros(rest) + 1).astype(np.uint8))
+        return self
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / np.sum(np.exp2(-self.registers.astype(float)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if e <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            e = m * np.log(m / zeros)
+        return float(e)
+
+    def relative_error(self):
+        return 1.04 / np.sqrt(len(self.registers))
+
+
+class StreamingStats:
+    """One-pass summary of every column: moments, t-digest quantiles and HyperLogLog distinct counts."""
+
+    def __init__(self):
+        self.columns = {}
+
+    def update(self, chunk):
+        for col in chunk.columns:
+            s = chunk[col]
+            c = self.columns.setdefault(col, {'nulls': 0, 'hll': HyperLogLog(), 'numeric': None})
+            c['nulls'] += int(s.isna().sum())
+            c['hll'].update(s)
+            if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+                values = s.to_numpy(dtype=float, na_value=np.nan)
+                values = values[~np.isnan(values)]
+                if c['numeric'] is None:
+                    c['numeric'] = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'digest': TDigest()}
+                self._merge_moments(c['numeric'], len(values), values.mean() if len(values) else 0.0,
+                                    ((values - values.mean()) ** 2).sum() if len(values) else 0.0)
+                c['numeric']['digest'].update(values)
+        return self
+
+    @staticmethod
+    def _merge_moments(acc, n, mean, m2):
+        # Chan et al. parallel update of count, mean and sum of squared deviations
+        if not n:
+            return
+        total = acc['n'] + n
+        delta = mean - acc['mean']
+        acc['m2'] += m2 + delta ** 2 * acc['n'] * n / total
+        acc['mean'] += delta * n / total
+        acc['n'] = total
+
+    def merge(self, other):
+        for col, o in other.columns.items():
+            c = self.columns.setdefault(col, {'nulls': 0, 'hll': HyperLogLog(), 'numeric': None})
+            c['nulls'] += o['nulls']
+            c['hll'].merge(o['hll'])
+            if o['numeric'] is not None:
+                if c['numeric'] is None:
+                    c['numeric'] = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'digest': TDigest()}
+                self._merge_moments(c['numeric'], o['numeric']['n'], o['numeric']['mean'], o['numeric']['m2'])
+                c['numeric']['digest'].merge(o['numeric']['digest'])
+        return self
+
+    def summary(self):
+        # describe()-like table with the distinct count and the error bounds
+        out = {}
+        for col, c in self.columns.items():
+            distinct = c['hll'].estimate()
+            row = {'distinct (approx.)': round(distinct),
+                   'distinct error (±)': round(distinct * c['hll'].relative_error()),
+                   'nulls': c['nulls']}
+            num = c['numeric']
+            if num is not None and num['n']:
+                d = num['digest']
+                row.update({'count': num['n'],
+                            'mean': num['mean'],
+                            'std': np.sqrt(num['m2'] / (num['n'] - 1)) if num['n'] > 1 else np.nan,
+                            'min': d.min,
+                            '25%': d.quantile(0.25),
+                            '50%': d.quantile(0.5),
+                            '75%': d.quantile(0.75),
+                            'max': d.max,
+                            'quantile rank error (±%)': 100 * max(d.rank_error(q) for q in (0.25, 0.5, 0.75))})
+            out[col] = row
+        index = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max', 'quantile rank error (±%)',
+                 'distinct (approx.)', 'distinct error (±)', 'nulls']
+        return pd.DataFrame(out).reindex(index)
+
+
+def approx_stats(chunks):
+    stats = StreamingStats()
+    for chunk in chunks:
+        stats.update(chunk)
+    return stats.summary()
+
+
+def frame_chunks(df, chunk_rows=CHUNK_ROWS):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+def approx_describe(df=None, store=None):
+    # Approximate statistics of an in-memory frame, or of the out-of-core
+    # store read back in chunks without building the full frame
+    if store is not None:
+        return dataset_cache.get_or_compute(('approx-stats', store.path), lambda: approx_stats(store.iter_chunks(CHUNK_ROWS)))
+    return dataset_cache.get_or_compute(('approx-stats', dataset_key(df)), lambda: approx_stats(frame_chunks(df)))
@@ -0,0 +1,101 @@
+# Precomputed distribution summaries for the Box and Violin charts
+#
+# px.box and px.violin send every observation so that plotly.js can compute
+# quartiles and kernel densities in the browser. Here each x / color / facet
+# group is summarised once on the server: quartiles, whiskers and mean for
+# the boxes, a fixed grid of quantiles for the violin outline and a capped,
+# evenly spread set of outliers. The figure is built from those, so its size
+# depends on the number of groups and not on the number of rows.
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from aggregate import group_columns
+from binning import box_summary, quantile_grid, GROUP_COLUMN, VIOLIN_POINTS
+from cache import dataset_cache, dataset_key
+
+OUTLIER_CAP = 200
+STATS = ['q1', 'median', 'q3', 'lowerfence', 'upperfence', 'mean']
+
+
+def _groups(df, by):
+    if not by:
+        return {(): np.arange(len(df))}
+    return {k if isinstance(k, tuple) else (k,): v for k, v in df.groupby([df[c] for c in by], observed=True).indices.items()}
+
+
+def _frame(rows, by, df):
+    out = pd.DataFrame(rows)
+    for col in by:
+        out[col] = out[col].astype(df[col].dtype)
+    return out
+
+
+def distribution_summary(df, value, by=(), points=VIOLIN_POINTS, outliers=OUTLIER_CAP):
+    # Returns three frames, all carrying the by columns and GROUP_COLUMN:
+    #   stats     one row per group with STATS and the row count
+    #   grid      up to points quantiles of value per group, a stand-in
+    #             sample with the same distribution for drawing violins
+    #   outliers  up to outliers values per group beyond the whiskers,
+    #             spread evenly over the sorted outliers
+    by = group_columns(by, value)
+    key = ('distribution', dataset_key(df), value, tuple(by), points, outliers)
+
+    def compute():
+        values = df[value].to_numpy(dtype=float, na_value=np.nan)
+        stats, grid, outer = [], [], []
+        for i, (group, positions) in enumerate(_groups(df, by).items()):
+            xs = np.sort(values[positions])
+            xs = xs[~np.isnan(xs)]
+            if not len(xs):
+                continue
+            labels = dict(zip(by, group), **{GROUP_COLUMN: i})
+            summary = box_summary(xs)
+            stats.append(dict(labels, count=len(xs), **summary))
+            grid.append(pd.DataFrame(dict(labels, **{value: quantile_grid(xs, points)})))
+            out = np.r_[xs[xs < summary['lowerfence']], xs[xs > summary['upperfence']]]
+            if len(out) > outliers:
+                out = out[np.linspace(0, len(out) - 1, outliers).round().astype(np.int64)]
+            if len(out):
+                outer.append(pd.DataFrame(dict(labels, **{value: out})))
+        columns = [*by, GROUP_COLUMN, value]
+        grid = pd.concat(grid, ignore_index=True) if grid else pd.DataFrame(columns=columns)
+        outer = pd.concat(outer, ignore_index=True) if outer else pd.DataFrame(columns=columns)
+        return (_frame(stats, by, df).set_index(GROUP_COLUMN, drop=False),
+                _frame(grid, by, df), _frame(outer, by, df))
+
+    return dataset_cache.get_or_compute(key, compute)
+
+
+def summarize_distributions(fig, stats, outliers, x, value):
+    # Rework the box / violin traces of a figure drawn from the grid of
+    # distribution_summary (with GROUP_COLUMN as hover data): boxes get the
+    # exact precomputed statistics, and the capped outliers are added as an
+    # overlay of points lined up with each trace
+    for trace in list(fig.data):
+        if trace.type not in ('box', 'violin') or trace.customdata is None or not len(trace.customdata):
+            continue
+        ids = pd.unique(np.asarray(trace.customdata)[:, 0].astype(np.int64))
+        rows = stats.loc[ids]
+        if trace.type == 'box':
+            trace.update(x=rows[x] if x else None, y=None, boxpoints=False,
+                         **{s: rows[s] for s in STATS})
+        else:
+            trace.update(points=False)
+        trace.update(customdata=None, hovertemplate=None)
+
+        points = outliers.loc[outliers[GROUP_COLUMN].isin(ids)]
+        if not len(points):
+            continue
+        overlay = dict(x=points[x] if x else None, y=points[value], name=trace.name,
+                       xaxis=trace.xaxis, yaxis=trace.yaxis,
+                       legendgroup=trace.legendgroup, offsetgroup=trace.offsetgroup,
+                       alignmentgroup=trace.alignmentgroup, showlegend=False,
+                       marker=dict(color=trace.marker.color), line=dict(width=0),
+                       fillcolor='rgba(0,0,0,0)', hoveron='points', pointpos=0, jitter=0)
+        if trace.type == 'box':
+            fig.add_trace(go.Box(boxpoints='all', **overlay))
+        else:
+            fig.add_trace(go.Violin(points='all', **overlay))
+    return fig
+